@@ -0,0 +1,22 @@
+"""
+Management command, lives in management/commands/ of the app
+Geocodes locations saved before latitude/longitude columns were added, LocationView search
+returns nothing for a location until it has coordinates. Run once after migrating:
+    python manage.py backfill_location_coordinates
+Safe to run again, only rows without coordinates are geocoded
+"""
+from django.core.management.base import BaseCommand
+
+from ...helper.destination_helper import backfill_coordinates
+from ...models import Location
+
+
+class Command(BaseCommand):
+    help = 'Geocode addresses of locations that have no coordinates yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        updated, not_found = backfill_coordinates(Location.objects.all(), options['batch_size'])
+        self.stdout.write(f'Geocoded {updated} locations, {not_found} addresses not found')
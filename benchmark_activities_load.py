@@ -0,0 +1,106 @@
+"""
+Load test participant activities through the sync and the async stack against the configured database.
+Both routes are served by one uvicorn worker, uncached, so only the session/driver path differs.
+Sync routes run in the anyio threadpool (40 threads by default), async routes on the event loop
+
+    ASYNC_DATABASE_DRIVER=postgresql+asyncpg python benchmark_activities_load.py <ppmi_id> <event_id>
+"""
+from fastapi import Depends, FastAPI, Response
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+import activity_service
+import asyncio
+import httpx
+import socket
+import subprocess
+import sys
+import time
+from session import get_async_session, get_session
+
+concurrency_levels = (100, 500, 1000)
+requests_per_client = 10
+
+app = FastAPI()
+
+
+@app.get("/sync/{ppmi_id}/{event_id}")
+def sync_route(ppmi_id: int, event_id: int, db: Session = Depends(get_session)):
+    event_model = activity_service.get_participant_activities(db, ppmi_id, event_id)
+    return Response(content=event_model.model_dump_json(), media_type="application/json")
+
+
+@app.get("/async/{ppmi_id}/{event_id}")
+async def async_route(ppmi_id: int, event_id: int, db: AsyncSession = Depends(get_async_session)):
+    event_model = await activity_service.get_participant_activities_async(db, ppmi_id, event_id)
+    return Response(content=event_model.model_dump_json(), media_type="application/json")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, fraction):
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+async def load(client, url, clients):
+    latencies = []
+    errors = 0
+
+    async def worker():
+        nonlocal errors
+        for _ in range(requests_per_client):
+            started = time.perf_counter()
+            try:
+                response = await client.get(url)
+                ok = response.status_code == 200
+            except httpx.HTTPError:
+                ok = False
+            latencies.append(time.perf_counter() - started)
+            errors += not ok
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(clients)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return percentile(latencies, 0.5), percentile(latencies, 0.99), len(latencies) / elapsed, errors
+
+
+async def run_loads(base_url, ppmi_id, event_id):
+    print(f"{'stack':>6} {'clients':>8} {'p50 ms':>10} {'p99 ms':>10} {'req/s':>10} {'errors':>7}")
+    for clients in concurrency_levels:
+        limits = httpx.Limits(max_connections=clients, max_keepalive_connections=clients)
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=120) as client:
+            for stack in ("sync", "async"):
+                url = f"/{stack}/{ppmi_id}/{event_id}"
+                await load(client, url, min(clients, 50))  # warm up pools and connections
+                p50, p99, rps, errors = await load(client, url, clients)
+                print(f"{stack:>6} {clients:>8} {p50 * 1000:>10.1f} {p99 * 1000:>10.1f} {rps:>10.0f} {errors:>7}")
+
+
+def run(ppmi_id, event_id):
+    port = free_port()
+    server = subprocess.Popen([
+        sys.executable, "-m", "uvicorn", "benchmark_activities_load:app",
+        "--port", str(port), "--log-level", "warning", "--backlog", "4096",
+    ])
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        for _ in range(100):
+            try:
+                httpx.get(f"{base_url}/sync/{ppmi_id}/{event_id}").raise_for_status()
+                break
+            except httpx.HTTPError:
+                time.sleep(0.1)
+        else:
+            raise RuntimeError(f"{base_url} did not serve participant {ppmi_id} event {event_id}")
+        asyncio.run(run_loads(base_url, ppmi_id, event_id))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]), int(sys.argv[2]))
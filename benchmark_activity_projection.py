@@ -0,0 +1,114 @@
+"""
+Per activity cost of building participant event responses, ORM entities with validated models
+as get_participant_activities did before, against column projection with model_construct
+
+    python benchmark_activity_projection.py
+"""
+from sqlalchemy import and_, create_engine
+from sqlalchemy.orm import contains_eager, sessionmaker
+import activity_service
+import enums
+import models
+import schemas
+import timeit
+
+activity_counts = (100, 500, 1000)
+
+
+def old_get_participant_activities(db, ppmi_id, event_id):
+    event = (
+        db.query(schemas.CalendarEvent)
+        .join(schemas.ScheduleEvent, schemas.CalendarEvent.schedule_event_id == schemas.ScheduleEvent.id)
+        .options(contains_eager(schemas.CalendarEvent.schedule_event))
+        .filter(schemas.CalendarEvent.id == event_id)
+        .first()
+    )
+    rows = (
+        db.query(schemas.Activity, schemas.ParticipantActivityStatus, schemas.Link.url)
+        .outerjoin(schemas.ParticipantActivityStatus, and_(
+            schemas.ParticipantActivityStatus.activity_id == schemas.Activity.id,
+            schemas.ParticipantActivityStatus.ppmi_id == ppmi_id,
+            schemas.ParticipantActivityStatus.calendar_event_id == event_id,
+        ))
+        .outerjoin(schemas.Link, and_(
+            schemas.Activity.type == enums.ActivityTypeEnum.link,
+            schemas.Link.id == schemas.Activity.related_entity_id,
+        ))
+        .filter(schemas.Activity.schedule_event_id == event.schedule_event_id)
+        .all()
+    )
+    activity_rows = {activity.id: (activity, status, url) for activity, status, url in rows}
+    schedule_event = event.schedule_event
+    return models.CalendarEventWithActivities(
+        event_id=event.id,
+        title=schedule_event.title,
+        start_time=event.start_time,
+        end_time=event.end_time,
+        description=schedule_event.description,
+        category=schedule_event.category,
+        status=event.status,
+        activities=[
+            models.ActivityWithStatus(
+                activity_id=activity.id,
+                name=activity.name,
+                description=activity.description,
+                type=activity.type,
+                related_entity_id=activity.related_entity_id,
+                related_entity_version=status.related_entity_version if status else None,
+                status=status.status if status else None,
+                link_url=url,
+            )
+            for activity, status, url in activity_rows.values()
+        ],
+        study=schedule_event.study,
+        event_type=schedule_event.event_type,
+    )
+
+
+def make_session(count):
+    engine = create_engine("sqlite://")
+    schemas.Base.metadata.create_all(engine)
+    db = sessionmaker(bind=engine, autoflush=False)()
+    db.add_all([
+        schemas.ScheduleEvent(id=1, title="Visit", description="d", category="visit", study="ppmi", event_type="onsite"),
+        schemas.CalendarEvent(id=10, schedule_event_id=1, status="scheduled"),
+        schemas.Link(id=5, url="https://abc.com/form"),
+    ])
+    for i in range(1, count + 1):
+        activity_type = enums.ActivityTypeEnum.link if i % 2 else enums.ActivityTypeEnum.survey
+        db.add(schemas.Activity(id=i, name=f"activity {i}", description="d", type=activity_type,
+                                related_entity_id=5, schedule_event_id=1))
+        if i % 3:
+            db.add(schemas.ParticipantActivityStatus(ppmi_id=7, calendar_event_id=10, activity_id=i,
+                                                     status="completed", related_entity_version="v1"))
+    db.commit()
+    db.expunge_all()
+    return db
+
+
+def run(repeat=5, number=20):
+    print(f"{'activities':>10} {'old us/row':>11} {'new us/row':>11} {'json us/row':>12} {'speedup':>8}")
+    for count in activity_counts:
+        db = make_session(count)
+        old = old_get_participant_activities(db, 7, 10)
+        db.expunge_all()
+        assert old.model_dump() == activity_service.get_participant_activities(db, 7, 10).model_dump()
+
+        def old_path():
+            old_get_participant_activities(db, 7, 10)
+            db.expunge_all()  # a request starts with an empty identity map
+
+        def new_path():
+            activity_service.get_participant_activities(db, 7, 10)
+
+        def json_path():
+            activity_service.get_participant_activities(db, 7, 10).model_dump_json()
+
+        per_row = [min(timeit.repeat(path, number=number, repeat=repeat)) / number / count * 10 ** 6
+                   for path in (old_path, new_path, json_path)]
+        print(f"{count:>10} {per_row[0]:>11.2f} {per_row[1]:>11.2f} {per_row[2]:>12.2f} {per_row[0] / per_row[1]:>7.1f}x")
+        db.close()
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,90 @@
+"""
+Compare LIST/MDTM parsers of ftp_connection with the split + dateutil path FTPHelper used before
+
+    python benchmark_ftp_parsing.py
+"""
+from dateutil import parser
+from ftp_connection import MONTHS, connection_timeout_decorator, parse_list_line, parse_mdtm
+import datetime
+import random
+import timeit
+
+entries = 100000
+
+
+@connection_timeout_decorator
+def old_parse_date_for_folder(self, input_arr: list) -> datetime.date:
+    if ":" in input_arr[-1]:
+        month = MONTHS[input_arr[1]]
+        day = int(input_arr[2])
+        year = datetime.datetime.now().year
+    else:
+        month = MONTHS[input_arr[0]]
+        day = int(input_arr[1])
+        year = int(input_arr[-1])
+    return datetime.date(year=year, month=month, day=day)
+
+
+def old_get_dates_for_folders(arr, path="/exports"):
+    res = {}
+    for line in arr:
+        params = line.split(" ")
+        res[f"{path}/{params[-1]}"] = old_parse_date_for_folder(None, params[-5:-1])
+    return res
+
+
+def new_get_dates_for_folders(arr, path="/exports"):
+    res = {}
+    today = datetime.date.today()
+    for line in arr:
+        entry = parse_list_line(line, today)
+        if entry:
+            res[f"{path}/{entry[0]}"] = entry[2]
+    return res
+
+
+def make_list_lines(count, recent=True, seed=0):
+    """
+    Single spaced lines, the only layout the old parser reads right.
+    Old parser reads year form ("Jan 01 2020") as month from size column and returns None,
+    so timing runs on recent entries ("Jan 01 10:00") where both parsers agree
+    """
+    rng = random.Random(seed)
+    today = datetime.date.today()
+    lines = []
+    for i in range(count):
+        date = today - datetime.timedelta(days=rng.randint(0, today.timetuple().tm_yday - 1))
+        when = f"{rng.randint(0, 23):02}:{rng.randint(0, 59):02}" if recent else str(date.year - 1)
+        lines.append(f"-rw-r--r-- 1 owner group {rng.randint(1, 10 ** 7)} {date:%b} {date.day:02} {when} file_{i}.csv")
+    return lines
+
+
+def make_mdtm_responses(count, seed=0):
+    rng = random.Random(seed)
+    start = datetime.datetime(2015, 1, 1)
+    return [f"213 {(start + datetime.timedelta(seconds=rng.randint(0, 10 ** 8))):%Y%m%d%H%M%S}" for _ in range(count)]
+
+
+def run(repeat=3):
+    lines = make_list_lines(entries)
+    responses = make_mdtm_responses(entries)
+    assert old_get_dates_for_folders(lines) == new_get_dates_for_folders(lines)
+    year_lines = make_list_lines(1000, recent=False)
+    misread = sum(date is None for date in old_get_dates_for_folders(year_lines).values())
+    assert None not in new_get_dates_for_folders(year_lines).values()
+    assert [parser.parse(r[4:].strip()) for r in responses[:1000]] == [parse_mdtm(r) for r in responses[:1000]]
+
+    cases = [
+        ("LIST", lambda: old_get_dates_for_folders(lines), lambda: new_get_dates_for_folders(lines)),
+        ("MDTM", lambda: [parser.parse(r[4:].strip()) for r in responses], lambda: [parse_mdtm(r) for r in responses]),
+    ]
+    print(f"{entries} entries, old LIST parser misreads {misread} of {len(year_lines)} year form lines")
+    print(f"{'format':>6} {'old ms':>10} {'new ms':>10} {'speedup':>8}")
+    for name, old, new in cases:
+        old_time = min(timeit.repeat(old, number=1, repeat=repeat))
+        new_time = min(timeit.repeat(new, number=1, repeat=repeat))
+        print(f"{name:>6} {old_time * 1000:>10.1f} {new_time * 1000:>10.1f} {old_time / new_time:>7.1f}x")
+
+
+if __name__ == '__main__':
+    run()
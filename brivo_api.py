@@ -1,75 +1,280 @@
 from googleapiclient.discovery import build
 from google_auth_oauthlib.flow import InstalledAppFlow
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 from datetime import datetime, timedelta
 from django.conf import settings
+from django.core.cache import cache
 import json
 import base64
 import ast
+import fcntl
 import os
 import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 base64_brivo_credentials = b"Basic " + base64.b64encode(
     str.encode("{}:{}".format(settings.BRIVO_CLIENT_ID, settings.BRIVO_CLIENT_SECRET)))
 
+brivo_timeout = getattr(settings, 'BRIVO_TIMEOUT', (3.05, 30))  # (connect, read) seconds
+brivo_pool_size = getattr(settings, 'BRIVO_POOL_SIZE', 20)
+retry_statuses = (429, 500, 502, 503, 504)
+unsent_retry_statuses = (429,)    # rejected before processing, safe to repeat a POST
+
+# Shared through the Django cache, so a membership change made by one worker is seen by all of them
+group_cache_timeout = getattr(settings, 'BRIVO_GROUP_CACHE_TTL', 60 * 10)
+membership_cache_timeout = getattr(settings, 'BRIVO_MEMBERSHIP_CACHE_TTL', 60 * 2)
+_cache_counts = {'groups': {'hits': 0, 'misses': 0}, 'memberships': {'hits': 0, 'misses': 0}}
+
+
+def _group_key(name):
+    return 'brivo_groups:' + base64.urlsafe_b64encode(name.encode()).decode()
+
+
+def _membership_key(user_id):
+    return f'brivo_memberships:{user_id}'
+
+
+def _cached(kind, key):
+    value = cache.get(key)
+    _cache_counts[kind]['hits' if value is not None else 'misses'] += 1
+    return value
+
+
+_session = {'pid': None, 'session': None, 'adapter': None}
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    One keep-alive connection pool per process, rebuilt after fork so workers don't share sockets
+    """
+    pid = os.getpid()
+    if _session['pid'] != pid:
+        with _session_lock:
+            if _session['pid'] != pid:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=2, pool_maxsize=brivo_pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session.update(pid=pid, session=session, adapter=adapter)
+    return _session['session']
+
+
+def _not_sent(error):
+    """
+    True when the connection failed before the request could reach the server
+    """
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def connection_stats():
+    """
+    How many requests went through the pool and how many connections it had to open for them
+    """
+    get_session()
+    pools = _session['adapter'].poolmanager.pools
+    stats = {'requests': 0, 'connections': 0}
+    for key in pools.keys():
+        pool = pools[key]
+        stats['requests'] += pool.num_requests
+        stats['connections'] += pool.num_connections
+    stats['reused'] = stats['requests'] - stats['connections']
+    return stats
+
+
+def cache_stats():
+    """
+    Hits and misses of this process
+    """
+    return {kind: dict(counts) for kind, counts in _cache_counts.items()}
+
+
+def invalidate_user_groups(user_id):
+    """
+    Drop cached memberships of {user_id}. Group lookups hold only ids and names, they expire with their timeout
+    """
+    cache.delete(_membership_key(user_id))
+
+
+class TokenManager:
+    """
+    Keeps Brivo token of one credentials file in memory for the whole process.
+    File is read again only when its mtime changes, token is refreshed {refresh_margin} seconds
+    before it expires. Only one worker calls the refresh endpoint: threads wait on a lock,
+    processes on a file lock, and all of them pick up the token it saved
+    """
+    update_token_url = 'https://auth.brivo.com/oauth/token?grant_type=refresh_token&refresh_token={}'
+    refresh_margin = getattr(settings, 'BRIVO_REFRESH_MARGIN', 300)
+
+    def __init__(self, path_to_creds):
+        self.path_to_creds = path_to_creds
+        self.data = None
+        self.mtime = None
+        self.auth_headers = None
+        self.json_headers = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            mtime = os.stat(self.path_to_creds).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self.mtime:
+            return
+        with open(self.path_to_creds, 'r') as token:
+            self._set(json.load(token), mtime)
+
+    def _set(self, data, mtime):
+        self.data = data
+        self.mtime = mtime
+        self.auth_headers = {
+            'api-key': settings.BRIVO_API_KEY,
+            'Authorization': f'bearer {data["access_token"]}'
+        }
+        self.json_headers = {**self.auth_headers, 'Content-type': 'application/json'}
+
+    def is_expiring(self, margin=None):
+        now = datetime.utcnow().timestamp()
+        return now >= self.data['expires_in'] - (self.refresh_margin if margin is None else margin)
+
+    def get(self):
+        """
+        Current token data, refreshed first when it is about to expire
+        """
+        self._load()
+        if self.data and self.is_expiring():
+            self.refresh(self.data['access_token'])
+        return self.data
+
+    def refresh(self, stale_token=None):
+        """
+        Refresh the token unless somebody has already replaced {stale_token} while we were waiting
+        """
+        with self._lock:
+            self._load()
+            if self.data is None or self.data['access_token'] != stale_token:
+                return self.data
+            with open(self.path_to_creds + '.lock', 'w') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    self._load()
+                    if self.data['access_token'] == stale_token:
+                        self._refresh()
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return self.data
+
+    def _refresh(self):
+        now = datetime.utcnow().timestamp()
+        url = self.update_token_url.format(self.data['refresh_token'])
+        r = get_session().post(url, headers={'Authorization': base64_brivo_credentials, 'api-key': settings.BRIVO_API_KEY},
+                               timeout=brivo_timeout)
+        token = ast.literal_eval(r.content.decode())
+        self.save(token, now)
+
+    def save(self, data, now):
+        data = {**data, 'expires_in': now + data['expires_in']}
+        tmp_path = f'{self.path_to_creds}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as token:
+            json.dump(data, token)
+        os.replace(tmp_path, self.path_to_creds)   # readers never see a half written file
+        self._set(data, os.stat(self.path_to_creds).st_mtime_ns)
+
+
+_token_managers = {}
+_token_managers_lock = threading.Lock()
+
+
+def get_token_manager(path_to_creds):
+    with _token_managers_lock:
+        if path_to_creds not in _token_managers:
+            _token_managers[path_to_creds] = TokenManager(path_to_creds)
+        return _token_managers[path_to_creds]
+
 
 class BrivoApi:
-    update_token_url = 'https://auth.brivo.com/oauth/token?grant_type=refresh_token&refresh_token={}'
     base_url = 'https://api.brivo.com/v1/api/'
     brivo_group_prefix = 'Tenants'
+    backoff_base = 0.5  # seconds
+    bulk_parallelism = getattr(settings, 'BRIVO_BULK_PARALLELISM', 8)
+    bulk_retries = 5
 
     def __init__(self, path_to_creds):
         self.path_to_creds = path_to_creds
-        if os.path.exists(self.path_to_creds):
-            with open(path_to_creds, 'r') as token:
-                self.data = json.load(token)
-                self.expires_in = self.data['expires_in']
-                self.access_token = self.data['access_token']
-                self.refresh_token = self.data['refresh_token']
-
-        if getattr(self, 'expires_in', False) and self.is_expired():
-            self.update_token()
+        self.tokens = get_token_manager(path_to_creds)
+        self.tokens.get()
+
+    @property
+    def data(self):
+        return self.tokens.data
+
+    @property
+    def expires_in(self):
+        return self.tokens.data['expires_in']
+
+    @property
+    def access_token(self):
+        return self.tokens.data['access_token']
+
+    @property
+    def refresh_token(self):
+        return self.tokens.data['refresh_token']
+
+    def _request(self, method, url, data=None, timeout=None, backoff_retries=0):
+        """
+        With {backoff_retries} request is repeated on 429/5xx and connection errors,
+        waiting Retry-After or exponentially growing delay between attempts.
+        POST is not idempotent, the server may have created the user already,
+        so it is repeated only on 429 and on connections that failed before sending
+        """
+        idempotent = method != 'POST'
+        statuses = retry_statuses if idempotent else unsent_retry_statuses
+        for attempt in range(backoff_retries + 1):
+            self.tokens.get()
+            headers = self.tokens.auth_headers if data is None else self.tokens.json_headers
+            try:
+                r = get_session().request(method, url, headers=headers, data=data, timeout=timeout or brivo_timeout)
+            except requests.ConnectionError as e:
+                if attempt == backoff_retries or not (idempotent or _not_sent(e)):
+                    raise
+            else:
+                if r.status_code not in statuses or attempt == backoff_retries:
+                    return r
+                retry_after = r.headers.get('Retry-After', '')
+                if retry_after.isdigit():
+                    time.sleep(int(retry_after))
+                    continue
+            time.sleep(self.backoff_base * 2 ** attempt + random.uniform(0, self.backoff_base))
 
     def is_expired(self):
-        now = datetime.utcnow().timestamp()
-        return now >= self.expires_in
+        return self.tokens.is_expiring(margin=0)
 
     def update_token(self):
-        now = datetime.utcnow().timestamp()
-        url = self.update_token_url.format(self.data['refresh_token'])
-        r = requests.post(url, headers={'Authorization': base64_brivo_credentials, 'api-key': settings.BRIVO_API_KEY})
-        token = ast.literal_eval(r.content.decode())
-        self.save_token(token, now)
+        self.tokens.refresh(self.access_token)
 
     def save_token(self, data, now):
-        self.expires_in = data['expires_in']
-        self.access_token = data['access_token']
-        self.refresh_token = data['refresh_token']
-        with open(self.path_to_creds, 'w') as token:
-            data['expires_in'] = now + data['expires_in']
-            json.dump(data, token)
+        self.tokens.save(data, now)
 
-    def create_user(self, data):
-        retries = 3
+    def create_user(self, data, backoff_retries=0):
+        retries = 1 if backoff_retries else 3   # _request does the retrying with backoff
         url = self.base_url + 'users'
         for retry in range(retries):
             data['pin'] = random.randint(1000, 9999)                                                    # 4 digit pin
-            r = requests.post(url, headers={
-                'api-key': settings.BRIVO_API_KEY,
-                'Authorization': f'bearer {self.access_token}',
-                'Content-type': 'application/json'
-            }, data=json.dumps(data))
+            r = self._request('POST', url, data=json.dumps(data), backoff_retries=backoff_retries)
             if r.status_code == 200:
                 break
         return json.loads(r.content)
 
     def update_user(self, user_id, data):
         url = self.base_url + 'users/' + str(user_id)
-        r = requests.put(url, headers={
-            'api-key': settings.BRIVO_API_KEY,
-            'Authorization': f'bearer {self.access_token}',
-            'Content-type': 'application/json'
-        }, data=json.dumps(data))
+        r = self._request('PUT', url, data=json.dumps(data))
         if r.status_code in [404, 400]:
             print("User was not updated, user not found.")
         else:
@@ -80,43 +285,46 @@ class BrivoApi:
 
     def delete_user(self, user_id):
         url = self.base_url + 'users/' + str(user_id)
-        r = requests.delete(url, headers={
-            'api-key': settings.BRIVO_API_KEY,
-            'Authorization': f'bearer {self.access_token}',
-        })
+        r = self._request('DELETE', url)
+        invalidate_user_groups(user_id)
 
     def list_groups(self, name):
+        cached = _cached('groups', _group_key(name))
+        if cached is not None:
+            return cached
         url = self.base_url + 'groups?' + f'filter=name__eq:{self.brivo_group_prefix} {name}'
 
-        r = requests.get(url,  headers={
-            'api-key': settings.BRIVO_API_KEY,
-            'Authorization': f'bearer {self.access_token}'})
-        return json.loads(r.content)
+        r = self._request('GET', url)
+        groups = json.loads(r.content)
+        if r.status_code == 200:
+            cache.set(_group_key(name), groups, timeout=group_cache_timeout)
+        return groups
 
     def retrieve_by_id(self, id):
         url = self.base_url + 'users/' + str(id)
 
-        r = requests.get(url,  headers={
-            'api-key': settings.BRIVO_API_KEY,
-            'Authorization': f'bearer {self.access_token}'})
+        r = self._request('GET', url)
         print(r.content)
         return json.loads(r.content)
 
     def retrieve_user_groups(self, id):
+        cached = _cached('memberships', _membership_key(id))
+        if cached is not None:
+            return cached
         url = self.base_url + 'users/' + str(id) + '/groups'
 
-        r = requests.get(url, headers={
-            'api-key': settings.BRIVO_API_KEY,
-            'Authorization': f'bearer {self.access_token}'})
+        r = self._request('GET', url)
         print(r.content)
-        return json.loads(r.content)
+        groups = json.loads(r.content)
+        if r.status_code == 200:
+            cache.set(_membership_key(id), groups, timeout=membership_cache_timeout)
+        return groups
 
 
-    def assign_user_to_group(self, user_id, group_id):
+    def assign_user_to_group(self, user_id, group_id, backoff_retries=0):
         url = self.base_url + f'groups/{group_id}/users/{user_id}'
-        r = requests.put(url, headers={
-            'api-key': settings.BRIVO_API_KEY,
-            'Authorization': f'bearer {self.access_token}'})
+        r = self._request('PUT', url, backoff_retries=backoff_retries)
+        invalidate_user_groups(user_id)
         if r.status_code in [404, 400]:
             print("The group or tenant not found. User didn't get access.")
         else:
@@ -126,9 +334,8 @@ class BrivoApi:
 
     def remove_user_from_group(self, user_id, group_id):
         url = self.base_url + f'groups/{group_id}/users/{user_id}/'
-        r = requests.delete(url, headers={
-            'api-key': settings.BRIVO_API_KEY,
-            'Authorization': f'bearer {self.access_token}'})
+        r = self._request('DELETE', url)
+        invalidate_user_groups(user_id)
 
         if r.status_code in [404, 400]:
             print("The group or tenant not found. User have access.")
@@ -137,9 +344,36 @@ class BrivoApi:
 
         return r
 
-
-
-
-
-
-
+    def _provision_tenant(self, index, data, group_id):
+        report = {'index': index, 'email': (data.get('emails') or [{}])[0].get('address'),
+                  'user_id': None, 'pin': None, 'assigned': False, 'error': None}
+        try:
+            tenant = self.create_user(dict(data), backoff_retries=self.bulk_retries)
+            report['user_id'] = tenant.get('id')
+            report['pin'] = tenant.get('pin')
+            if not report['user_id']:
+                report['error'] = f'User was not created - {tenant}'
+                return report
+            if group_id:
+                r = self.assign_user_to_group(report['user_id'], group_id, backoff_retries=self.bulk_retries)
+                report['assigned'] = r.status_code < 400
+                if not report['assigned']:
+                    report['error'] = f'User was not assigned to group {group_id}, status {r.status_code}'
+        except Exception as e:
+            report['error'] = str(e)
+        return report
+
+    def provision_tenants(self, tenants, group_id=None, parallelism=None):
+        """
+        Create many users and assign them to {group_id} concurrently.
+        Item of {tenants} is create_user data, it may have own "group_id" instead of the common one.
+        Returns report per item in the same order: index, email, user_id, pin, assigned, error
+        """
+        tenants = list(tenants)
+        with ThreadPoolExecutor(max_workers=parallelism or self.bulk_parallelism) as executor:
+            futures = [
+                executor.submit(self._provision_tenant, index, {k: v for k, v in data.items() if k != 'group_id'},
+                                data.get('group_id', group_id))
+                for index, data in enumerate(tenants)
+            ]
+            return [future.result() for future in futures]
@@ -0,0 +1,113 @@
+"""
+Local stand in for Brivo API, for tests and provisioning dry runs
+Should use like
+with BrivoStubServer(fail_every=3) as server:
+    BrivoApi.base_url = server.base_url
+    ...
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
+import json
+import re
+import threading
+
+
+class BrivoStubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'   # keep-alive, like the real API
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body=None, headers=None):
+        content = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _handle(self, method):
+        server = self.server
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        with server.lock:
+            number = next(server.counter)
+            server.calls.append((method, self.path))
+        if not self.headers.get('Authorization', '').lower().startswith('bearer'):
+            return self._reply(401, {'message': 'Unauthorized'})
+        if server.fail_every and number % server.fail_every == 0:
+            return self._reply(server.fail_status, {'message': 'Too many requests'}, {'Retry-After': '0'})
+
+        path = self.path.split('?')[0].rstrip('/')
+        if method == 'POST' and path.endswith('/users'):
+            with server.lock:
+                user = {**body, 'id': next(server.ids)}
+                server.users[user['id']] = user
+            return self._reply(200, user)
+        match = re.search(r'/groups/(\d+)/users/(\d+)$', path)
+        if match:
+            group_id, user_id = int(match.group(1)), int(match.group(2))
+            if user_id not in server.users:
+                return self._reply(404, {'message': 'User not found'})
+            with server.lock:
+                members = server.groups.setdefault(group_id, set())
+                if method == 'PUT':
+                    members.add(user_id)
+                else:
+                    members.discard(user_id)
+            return self._reply(204)
+        match = re.search(r'/users/(\d+)/groups$', path)
+        if match and method == 'GET':
+            user_id = int(match.group(1))
+            data = [{'id': group_id} for group_id, members in server.groups.items() if user_id in members]
+            return self._reply(200, {'data': data, 'count': len(data)})
+        if path.endswith('/groups') and method == 'GET':
+            return self._reply(200, {'data': [{'id': group_id} for group_id in server.groups], 'count': len(server.groups)})
+        return self._reply(404, {'message': 'Not found'})
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+
+class BrivoStubServer(ThreadingHTTPServer):
+    """
+    Keeps users and group memberships in memory.
+    Every {fail_every}-th request is answered with {fail_status} to exercise retries
+    """
+    daemon_threads = True
+
+    def __init__(self, fail_every=0, fail_status=429):
+        super().__init__(('127.0.0.1', 0), BrivoStubHandler)
+        self.fail_every = fail_every
+        self.fail_status = fail_status
+        self.lock = threading.Lock()
+        self.counter = itertools.count(1)
+        self.ids = itertools.count(1)
+        self.calls = []
+        self.users = {}
+        self.groups = {}
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/v1/api/'
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+        self.server_close()
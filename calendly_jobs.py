@@ -0,0 +1,184 @@
+"""
+Queue of Calendly deliveries, stored in the Django cache so a job outlives the process that accepted it.
+CACHES must be shared and persistent (Redis, database cache), local memory cache loses jobs on restart.
+Should use like
+state, created = enqueue(key, payload)
+Job is stored before the webhook answers 202, workers run Brivo provisioning and the welcome email,
+failures are retried with exponential backoff up to {max_attempts} times.
+Jobs left pending by a stopped process are submitted again by resume_pending(), called by the
+resume_calendly_jobs command (run it from cron) and once by every process on its first enqueue
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from dateutil.parser import parse
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+import logging
+import threading
+import time
+
+from apies.brivo_api import BrivoApi
+from ..models import Location
+from .confirm_subscription_service import send_mail
+
+logger = logging.getLogger('django')
+
+phone_field_name = 'phone number'
+job_timeout = 60 * 60 * 24 * 7      # Calendly retries deliveries for a few days
+lease_timeout = 60 * 10             # a worker killed mid job blocks its retry at most this long
+max_attempts = getattr(settings, 'CALENDLY_JOB_ATTEMPTS', 5)
+backoff_base = getattr(settings, 'CALENDLY_JOB_BACKOFF', 30)
+pending_key = 'calendly_jobs:pending'
+pending_lock_key = 'calendly_jobs:pending:lock'
+
+executor = ThreadPoolExecutor(max_workers=getattr(settings, 'CALENDLY_HOOK_WORKERS', 4),
+                              thread_name_prefix='calendly')
+_resumed = threading.Event()
+
+
+def phone_answer(questions):
+    answers = [q.get('answer') for q in questions if q.get('question', '').lower() == phone_field_name]
+    return answers[0] if answers else None
+
+
+def _update_pending(change):
+    # Django cache has no atomic set operations, the index is changed under a short cache lock
+    for _ in range(100):
+        if cache.add(pending_lock_key, 1, timeout=5):
+            try:
+                pending = cache.get(pending_key) or set()
+                change(pending)
+                cache.set(pending_key, pending, timeout=job_timeout)
+            finally:
+                cache.delete(pending_lock_key)
+            return
+        time.sleep(0.05)
+    raise RuntimeError(f'{pending_lock_key} was not released')
+
+
+def _submit(key):
+    try:
+        executor.submit(run_job, key)
+    except RuntimeError:
+        pass    # executor shut down, the job stays pending for resume_pending()
+
+
+def enqueue(key, payload):
+    """
+    Stores payload under idempotency {key} and submits it to the workers.
+    Returns (state, created), a duplicate delivery returns state of the stored job and created False
+    """
+    if not _resumed.is_set():
+        _resumed.set()
+        resume_pending()
+    job = {'state': 'pending', 'payload': payload, 'attempts': 0, 'brivo_user': None, 'error': None}
+    if not cache.add(key, job, timeout=job_timeout):
+        stored = cache.get(key)
+        return (stored or {}).get('state', 'pending'), False
+    _update_pending(lambda pending: pending.add(key))
+    _submit(key)
+    return 'pending', True
+
+
+def resume_pending():
+    """
+    Submits every pending job, returns how many. A job already running elsewhere is skipped by its lease
+    """
+    keys = cache.get(pending_key) or set()
+    for key in keys:
+        _submit(key)
+    return len(keys)
+
+
+def _retry_later(key, attempts):
+    timer = threading.Timer(backoff_base * 2 ** (attempts - 1), _submit, [key])
+    timer.daemon = True
+    timer.start()
+
+
+def run_job(key):
+    lease = f'{key}:lease'
+    if not cache.add(lease, 1, timeout=lease_timeout):
+        return
+    try:
+        job = cache.get(key)
+        if not job or job['state'] != 'pending':
+            _update_pending(lambda pending: pending.discard(key))
+            return
+        try:
+            job['state'] = _process(key, job)
+        except Exception as e:
+            job['attempts'] += 1
+            job['error'] = str(e)
+            if job['attempts'] >= max_attempts:
+                job['state'] = 'failed'
+                logger.error(f'Calendly job {key} failed after {job["attempts"]} attempts - {e}')
+            else:
+                logger.warning(f'Calendly job {key} attempt {job["attempts"]} failed - {e}')
+        cache.set(key, job, timeout=job_timeout)
+        if job['state'] == 'pending':
+            _retry_later(key, job['attempts'])
+        else:
+            _update_pending(lambda pending: pending.discard(key))
+    finally:
+        cache.delete(lease)
+        connections.close_all()
+
+
+def _process(key, job):
+    """
+    Returns 'done', or 'ignored' when no location matches the event, raises when Brivo or email failed.
+    Created Brivo user is stored in the job, so a retry after a failed email does not create
+    a second user with another pin
+    """
+    brivo = BrivoApi(settings.BRIVO_API_CREDENTIAL)
+    payload = job['payload']
+
+    event = payload.get('event', {})
+    event_type = payload.get('event_type', {})
+    invitee = payload.get('invitee', {})
+    start_time = event.get('start_time')
+
+    event_name = event_type.get('name')
+    user_email = invitee.get('email')
+    user_name = invitee.get('name')
+    phone = phone_answer(payload.get('questions_and_answers', {}))
+    first_name = invitee.get('first_name')
+    last_name = invitee.get('last_name')
+
+    location = Location.objects.filter(title__icontains=event_name.strip()).first()
+    if not location:
+        print(f'Location {event_name} not found')
+        return 'ignored'
+    end_time = parse(start_time) + timedelta(days=1)
+    end_time = end_time.strftime('%Y-%m-%dT%H:%M:%SZ')
+    data = {
+        'firstName': first_name if first_name else user_name,
+        'lastName': last_name if last_name else user_name,
+        'emails': [{"address": user_email, "type": 'home'}],
+        'phoneNumbers': [{"number": phone, "type": 'home'}],
+        'effectiveFrom': start_time,
+        'effectiveTo': end_time
+    }
+    tenant = job['brivo_user']
+    if not tenant:
+        tenant = brivo.create_user(data)
+        print(tenant)
+        if not tenant.get('id'):
+            raise Exception(f'Brivo user was not created - {tenant}')
+        job['brivo_user'] = tenant
+        cache.set(key, job, timeout=job_timeout)
+        print('Tenant Created')
+    if location.brivo_group and location.brivo_group.brivo_id:
+        r = brivo.assign_user_to_group(tenant['id'], location.brivo_group.brivo_id)
+        if r.status_code >= 400:
+            raise Exception(f'Brivo user {tenant["id"]} was not assigned to group, status {r.status_code}')
+    start_time = parse(start_time)
+    send_mail(
+        context={'location': location, 'tour_date': start_time.strftime("%B %d, %Y at %I:%M %p"), 'pin': tenant['pin'],
+                 'pin_effective_date': start_time.strftime("%B %d, %Y"), 'name': first_name if first_name else user_name},
+        template='email/calendly_welcome.html', title='Local Locker Tour Confirmation',
+        to=[user_email]
+    )
+    return 'done'
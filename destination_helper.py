@@ -1,30 +1,120 @@
 from geopy.geocoders import Nominatim, GoogleV3
-from geopy.distance import great_circle
 from django.conf import settings
+from .ttl_cache import TTLCache
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+import time
 
 
 geo = GoogleV3(api_key=settings.GOOGLE_GEOCODING_API_KEY)
+geo_components = {"city": "New York", "country": "United States"}
 
+search_cache = TTLCache(
+    maxsize=getattr(settings, 'GEOCODE_SEARCH_CACHE_SIZE', 1024),
+    ttl=getattr(settings, 'GEOCODE_SEARCH_CACHE_TTL', 60 * 60 * 24),
+)
+geocode_executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, 'GEOCODE_CONCURRENCY', 8), thread_name_prefix='geocode')
+_in_flight = {}
+_in_flight_lock = threading.RLock()
 
-def get_distance_by_address(location, address, limit=5, threshold=1.75):
-    locations_list = []
-    address = geo.geocode(address, components={"city": "New York", "country": "United States"})
-    if not address:
-        print(f'User address is not found . Address {address}')
-        return locations_list
-    lat_long_address = (address.latitude, address.longitude)
-    for location in location.filter(address__isnull=False):
-        loc = geo.geocode(location.address, components={"city": "New York", "country": "United States"})
 
-        if not loc:
-            print(f"Location the address is not found. Address {location.address}")
-            continue
+class RateLimiter:
+    """
+    Lets through at most {rate} calls per second, callers over the limit sleep until their slot
+    """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._next = 0.0
+        self._lock = threading.Lock()
 
-        lat_long = (loc.latitude, loc.longitude)
-        measuring_distance = great_circle(lat_long_address, lat_long).miles
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
 
-        if measuring_distance <= threshold:
-            locations_list.append((location, measuring_distance))
-    locations_list = sorted(locations_list, key=lambda tup: tup[1])[:limit]
-    return [item[0] for item in locations_list]
 
+geocode_rate_limiter = RateLimiter(getattr(settings, 'GEOCODE_RATE_LIMIT', 40))
+
+
+def geocode_address(address):
+    point = geo.geocode(address, components=geo_components)
+    if not point:
+        return None
+    return point.latitude, point.longitude
+
+
+def _limited_geocode(address):
+    geocode_rate_limiter.wait()
+    return geocode_address(address)
+
+
+def _release(address, future):
+    with _in_flight_lock:
+        if _in_flight.get(address) is future:
+            del _in_flight[address]
+
+
+def submit_geocode(address):
+    """
+    Geocode {address} on the shared pool, requests for an address already in flight share its future
+    """
+    with _in_flight_lock:
+        future = _in_flight.get(address)
+        if future is None:
+            future = geocode_executor.submit(_limited_geocode, address)
+            _in_flight[address] = future
+            future.add_done_callback(lambda done: _release(address, done))
+    return future
+
+
+def geocode_search(address):
+    """
+    Geocode user search text, repeated searches are served from the local LRU/TTL cache
+    """
+    key = ' '.join(address.lower().split())
+    lat_long = search_cache.get(key)
+    if lat_long is None:
+        lat_long = geocode_address(address)
+        if lat_long:
+            search_cache.set(key, lat_long)
+    return lat_long
+
+
+def backfill_coordinates(queryset, batch_size=500):
+    """
+    Fill latitude/longitude of GeoLocationMixin rows that have an address but no coordinates.
+    Addresses of a batch are geocoded concurrently on the shared pool, rows are written with bulk_update,
+    so save() does not geocode them again. Returns (updated, not_found)
+    """
+    rows = queryset.filter(latitude__isnull=True, address__isnull=False).exclude(address='')\
+        .only('pk', 'address').order_by('pk')
+    updated = not_found = 0
+    last_pk = None
+    while True:
+        batch = list((rows.filter(pk__gt=last_pk) if last_pk is not None else rows)[:batch_size])
+        if not batch:
+            return updated, not_found
+        last_pk = batch[-1].pk
+        futures = {}
+        for row in batch:
+            futures.setdefault(submit_geocode(row.address), []).append(row)
+        done = []
+        for future in as_completed(futures):
+            try:
+                lat_long = future.result()
+            except Exception as e:
+                print(f"Geocoding failed with exception - {e}")
+                lat_long = None
+            for row in futures[future]:
+                if not lat_long:
+                    print(f"Location the address is not found. Address {row.address}")
+                    not_found += 1
+                    continue
+                row.latitude, row.longitude = lat_long
+                done.append(row)
+        queryset.model.objects.bulk_update(done, ['latitude', 'longitude'])
+        updated += len(done)
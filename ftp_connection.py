@@ -1,8 +1,18 @@
 # Stdlib imports
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from dateutil import parser
+import atexit
+import contextlib
 import datetime
+import fnmatch
 import ftplib
+import functools
 import logging
+import os
+import re
+import ssl
+import threading
+import time
 
 # Core Django imports
 
@@ -15,6 +25,12 @@ import logging
 logger = logging.getLogger('django')
 
 TLS_TYPES = ["ftps", "ftpes"]
+FILE_EXTENSIONS = ["csv", "txt", "xlsx"]
+SCAN_WORKERS = 4
+BLOCK_SIZE = 64 * 1024
+POOL_SIZE = 4               # sessions per (type, host, username)
+POOL_IDLE_TIMEOUT = 300     # seconds
+POOL_ACQUIRE_TIMEOUT = 60   # seconds
 MONTHS = {
     "Jan": 1,
     "Feb": 2,
@@ -29,42 +45,236 @@ MONTHS = {
     "Nov": 11,
     "Dec": 12,
 }
+# drwxr-xr-x 2 owner group 4096 Jan 01 10:00 name (owner or group may be missing)
+UNIX_LIST_RE = re.compile(
+    r"^(?P<type>[-dlbcps])\S*\s+(?:\S+\s+){1,3}?\d+\s+(?P<month>[A-Z][a-z]{2})\s+(?P<day>\d{1,2})\s+"
+    r"(?:\d{1,2}:\d{2}|(?P<year>\d{4}))\s+(?P<name>.+)$"
+)
+# 01-31-20  10:00AM  <DIR>  name
+WINDOWS_LIST_RE = re.compile(
+    r"^(?P<month>\d{2})-(?P<day>\d{2})-(?P<year>\d{2}(?:\d{2})?)\s+\d{1,2}:\d{2}[AP]M\s+"
+    r"(?:(?P<dir><DIR>)|\d+)\s+(?P<name>.+)$"
+)
+# 213 YYYYMMDDHHMMSS[.sss]
+MDTM_RE = re.compile(r"^213\s+(\d{4})(\d{2})(\d{2})(\d{2})(\d{2})(\d{2})")
+
+
+@functools.lru_cache(maxsize=4096)
+def _unix_list_date(month: str, day: str, year: str, today: datetime.date) -> datetime.date:
+    if year:
+        return datetime.date(int(year), MONTHS[month], int(day))
+    # recent entries have time instead of year, they are not older than half a year
+    date = datetime.date(today.year, MONTHS[month], int(day))
+    if date > today + datetime.timedelta(days=1):
+        date = date.replace(year=today.year - 1)
+    return date
+
+
+@functools.lru_cache(maxsize=4096)
+def _windows_list_date(month: str, day: str, year: str) -> datetime.date:
+    year = int(year)
+    return datetime.date(year + 2000 if year < 70 else year + 1900 if year < 100 else year, int(month), int(day))
+
+
+def parse_list_line(line: str, today: datetime.date = None):
+    """
+    Parse line of LIST answer in unix or windows format
+    Returns (name, is_folder, date) or None for lines that are not entries (total, ., ..)
+    Dates are cached, listings have few distinct ones
+    """
+    match = UNIX_LIST_RE.match(line)
+    if match:
+        entry_type, month, day, year, name = match.groups()
+        date = _unix_list_date(month, day, year, today or datetime.date.today())
+        is_folder = entry_type == "d"
+    else:
+        match = WINDOWS_LIST_RE.match(line)
+        if not match:
+            return None
+        month, day, year, folder, name = match.groups()
+        date = _windows_list_date(month, day, year)
+        is_folder = folder is not None
+    if name == "." or name == "..":
+        return None
+    return name, is_folder, date
+
+
+def parse_mdtm(response: str) -> datetime.datetime:
+    """
+    Parse MDTM answer, fixed format is parsed by regex, anything else by dateutil
+    """
+    match = MDTM_RE.match(response)
+    if match:
+        return datetime.datetime(*map(int, match.groups()))
+    return parser.parse(response[4:].strip())
 
 
 def connection_timeout_decorator(func):
     """
     Decorator for reconnect after timeout and retry a function
     """
-    def wrapper(self, *args):
+    def wrapper(self, *args, **kwargs):
         try:
-            return func(self, *args)
+            return func(self, *args, **kwargs)
         except Exception as e:
             try:
                 logger.debug(f"Reconnection on func - {func} with exception - {e}")
-                self.ftp = self._get_ftp()
-                self._login()
-                return func(self, *args)
+                self._reconnect()
+                return func(self, *args, **kwargs)
             except Exception as totally_e:
                 logger.debug(f"Totally failed in func - {func}, with exception - {totally_e}\n Arguments - {args}")
     return wrapper
 
 
+class FTPPool:
+    """
+    Logged in FTP/FTPS sessions keyed by (type, host, username)
+    At most {max_size} sessions per key, idle session is checked with NOOP before it is given out
+    and closed with QUIT after {idle_timeout} seconds without use, by a daemon reaper thread that runs
+    while the pool has idle sessions
+    """
+    def __init__(self, max_size=POOL_SIZE, idle_timeout=POOL_IDLE_TIMEOUT, acquire_timeout=POOL_ACQUIRE_TIMEOUT):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.acquire_timeout = acquire_timeout
+        self._idle = {}     # key -> [(ftp, released_at)]
+        self._open = {}     # key -> number of sessions, idle and in use
+        self._cond = threading.Condition()
+        self._reaper = None
+
+    @staticmethod
+    def _alive(ftp) -> bool:
+        try:
+            ftp.voidcmd("NOOP")
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close(ftp):
+        try:
+            ftp.quit()
+        except Exception:
+            try:
+                ftp.close()
+            except Exception:
+                pass
+
+    def _reap_loop(self):
+        while True:
+            time.sleep(max(self.idle_timeout / 2, 1))
+            self.reap()
+            with self._cond:
+                if not any(self._idle.values()):
+                    self._reaper = None
+                    return
+
+    def _start_reaper(self):
+        # called with self._cond held, thread is not inherited by forked workers so it is checked every time
+        if self._reaper is None or not self._reaper.is_alive():
+            self._reaper = threading.Thread(target=self._reap_loop, name="ftp-pool-reaper", daemon=True)
+            self._reaper.start()
+
+    def acquire(self, key, connect):
+        """
+        Idle healthy session for {key} or a new one made by {connect}
+        Waits for a free slot when {max_size} sessions are in use
+        """
+        deadline = time.monotonic() + self.acquire_timeout
+        self.reap()
+        while True:
+            with self._cond:
+                idle = self._idle.get(key)
+                if idle:
+                    ftp = idle.pop()[0]
+                elif self._open.get(key, 0) < self.max_size:
+                    self._open[key] = self._open.get(key, 0) + 1
+                    ftp = None
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError(f"No free FTP session for {key[1]} in {self.acquire_timeout} seconds")
+                    self._cond.wait(remaining)
+                    continue
+            if ftp is None:
+                try:
+                    return connect()
+                except Exception:
+                    self.discard(key, None)
+                    raise
+            if self._alive(ftp):
+                return ftp
+            self.discard(key, ftp)
+
+    def release(self, key, ftp):
+        with self._cond:
+            self._idle.setdefault(key, []).append((ftp, time.monotonic()))
+            self._cond.notify()
+            self._start_reaper()
+        self.reap()
+
+    def discard(self, key, ftp):
+        """
+        Forget broken session
+        """
+        if ftp is not None:
+            self._close(ftp)
+        with self._cond:
+            self._open[key] = max(self._open.get(key, 0) - 1, 0)
+            self._cond.notify()
+
+    def reap(self):
+        """
+        Close sessions idle for more than {idle_timeout}
+        """
+        expired = time.monotonic() - self.idle_timeout
+        closing = []
+        with self._cond:
+            for key, idle in self._idle.items():
+                stale = [ftp for ftp, released_at in idle if released_at < expired]
+                if stale:
+                    idle[:] = [item for item in idle if item[1] >= expired]
+                    self._open[key] -= len(stale)
+                    closing.extend(stale)
+                    self._cond.notify(len(stale))
+        # QUIT waits for the server, done outside of the lock
+        for ftp in closing:
+            self._close(ftp)
+
+    def close_all(self):
+        with self._cond:
+            closing = []
+            for key, idle in self._idle.items():
+                self._open[key] -= len(idle)
+                closing.extend(ftp for ftp, _ in idle)
+            self._idle.clear()
+        for ftp in closing:
+            self._close(ftp)
+
+
+ftp_pool = FTPPool()
+atexit.register(ftp_pool.close_all)
+
+
 class FTPHelper:
     """
     Should use like
     with FTPHelper(path, username, password) as ftp:
         ftp......
     Because it will close automatically after using
+    Session is taken from shared {pool} and returned to it on close, pool=None opens own connection
     """
-    def __init__(self, path, username, password):
+    def __init__(self, path, username, password, pool=ftp_pool):
         self.type = path.split("://")[0]
         self.path = path.split("://")[1]
         self.credentials = {
             "username": username,
             "password": password
         }
-        self.ftp = self._get_ftp()
-        self._login()
+        self.pool = pool
+        self._pool_key = (self.type, self.path, username)
+        self.ftp = self.pool.acquire(self._pool_key, self._connect) if self.pool else self._connect()
+        self._mlsd = None
 
     def __enter__(self):
         return self
@@ -88,10 +298,32 @@ class FTPHelper:
         if self.type in TLS_TYPES:
             self.ftp.prot_p()
 
+    def _connect(self):
+        self.ftp = self._get_ftp()
+        self._login()
+        return self.ftp
+
+    def _reconnect(self):
+        """
+        Replace broken session
+        """
+        if self.pool:
+            self.pool.discard(self._pool_key, self.ftp)
+            self.ftp = None
+            self.ftp = self.pool.acquire(self._pool_key, self._connect)
+        else:
+            self._connect()
+
     def close(self):
         """
-        Close connection
+        Close connection, pooled session goes back to the pool
         """
+        if self.ftp is None:
+            return
+        if self.pool:
+            self.pool.release(self._pool_key, self.ftp)
+            self.ftp = None
+            return
         try:
             self.ftp.quit()
         except:
@@ -109,82 +341,270 @@ class FTPHelper:
     def get_file_bytes(self, path, name):
         """
         Get bytes from file in {path} with {name}
+        Keeps the whole file in memory, use iter_file_chunks/download_to_file for big files
         """
         res = []
         self.ftp.retrbinary(f"RETR {path}/{name}", res.append)
         return res
 
+    @contextlib.contextmanager
+    def _retr(self, path, name, offset=0):
+        """
+        Open data connection for {path}/{name}, REST {offset} when it is set
+        """
+        self.ftp.voidcmd("TYPE I")
+        conn = self.ftp.transfercmd(f"RETR {path}/{name}", rest=offset or None)
+        try:
+            with conn:
+                yield conn
+                if isinstance(conn, ssl.SSLSocket):
+                    conn.unwrap()
+        finally:
+            try:
+                self.ftp.voidresp()
+            except ftplib.all_errors as e:
+                # 426 when the reader stopped before the end of file
+                logger.debug(f"Transfer of {path}/{name} ended with - {e}")
+
+    def iter_file_chunks(self, path, name, blocksize=BLOCK_SIZE, offset=0):
+        """
+        Yield chunks of file in {path} with {name} as they come, memory doesn't depend on file size
+        """
+        with self._retr(path, name, offset) as conn:
+            while True:
+                chunk = conn.recv(blocksize)
+                if not chunk:
+                    break
+                yield chunk
+
+    def _resume_offset(self, path, name, target) -> int:
+        """
+        Size of {target} when it is an unfinished download of the current remote file, otherwise 0.
+        Remote file must be bigger than {target} and not modified after {target} was last written
+        """
+        if not os.path.exists(target):
+            return 0
+        offset = os.path.getsize(target)
+        try:
+            self.ftp.voidcmd("TYPE I")
+            remote_size = self.ftp.size(f"{path}/{name}")
+            remote_modify = parse_mdtm(self.ftp.voidcmd(f"MDTM {path}/{name}"))
+        except ftplib.all_errors as e:
+            logger.debug(f"File - {path}/{name} can't be resumed - {e}")
+            return 0
+        local_modify = datetime.datetime.utcfromtimestamp(os.path.getmtime(target))
+        if remote_size is None or offset >= remote_size or remote_modify > local_modify:
+            return 0
+        return offset
+
     @connection_timeout_decorator
-    def get_files(self, excludes, path) -> dict:
+    def download_to_file(self, path, name, target, blocksize=BLOCK_SIZE, resume=False) -> int:
         """
-        Get all files in folder (path) except (excludes)
+        Write file in {path} with {name} to {target} path
+        With {resume} an unfinished {target} is kept and download continues from its size,
+        so retry after reconnection doesn't start from the beginning.
+        Complete or stale {target} (remote file changed since) is downloaded again from the start
+        Returns size of {target}
         """
-        pass
+        offset = self._resume_offset(path, name, target) if resume else 0
+        with open(target, "ab" if offset else "wb") as file:
+            for chunk in self.iter_file_chunks(path, name, blocksize, offset):
+                file.write(chunk)
+            return file.tell()
 
     @connection_timeout_decorator
-    def _parse_date_for_folder(self, input_arr: list) -> datetime.date:
+    def read_file_into(self, path, name, buffer, offset=0) -> int:
         """
-        When we get data from LIST command we should parse date
-        It is happened here
+        Read file in {path} with {name} straight into preallocated {buffer} (bytearray, mmap, ...)
+        starting from {offset} of the remote file. Returns number of bytes read
         """
-        if ":" in input_arr[-1]:
-            month = MONTHS[input_arr[1]]
-            day = int(input_arr[2])
-            year = datetime.datetime.now().year
-        else:
-            month = MONTHS[input_arr[0]]
-            day = int(input_arr[1])
-            year = int(input_arr[-1])
-        return datetime.date(year=year, month=month, day=day)
+        view = memoryview(buffer).cast("B")
+        read = 0
+        with self._retr(path, name, offset) as conn:
+            while read < len(view):
+                size = conn.recv_into(view[read:])
+                if not size:
+                    break
+                read += size
+        return read
 
     @connection_timeout_decorator
+    def get_files(self, excludes, path) -> dict:
+        """
+        Get all files in folder (path) except (excludes)
+        Returns {path/name: {"size": int or None, "modify": datetime}}, size is known only with MLSD
+        """
+        files = self.scan_files(path) if self.supports_mlsd() else None
+        if files is None:
+            dates = self._get_dates_parallel(self._nlst_files(path), SCAN_WORKERS)
+            files = {file: {"size": None, "modify": modify} for file, modify in dates.items()}
+        return {file: facts for file, facts in files.items() if file not in excludes}
+
     def _parse_date_for_file(self, input_str: str) -> datetime.datetime:
         """
         parse string date to datetime
         """
-        return parser.parse(input_str[4:].strip())
+        return parse_mdtm(input_str)
 
-    @connection_timeout_decorator
-    def get_dates_for_folders(self, path: str) -> dict:
+    def _list_entries(self, path: str) -> dict:
         """
-        Get dates for folders in (path)
+        Get {path/name: (is_folder, date)} for entries of LIST (path)
         """
         res = {}
         arr = []
         self.ftp.retrlines(f"LIST {path}", arr.append)
+        today = datetime.date.today()
         for line in arr:
-            params = line.split(" ")
-            res[f"{path}/{params[-1]}"] = self._parse_date_for_folder(params[-5:-1])
+            entry = parse_list_line(line, today)
+            if entry:
+                res[f"{path}/{entry[0]}"] = entry[1:]
         return res
 
     @connection_timeout_decorator
-    def get_dates_for_files(self, path: str) -> dict:
+    def get_dates_for_folders(self, path: str) -> dict:
         """
-        Get datetime for files in folder
+        Get dates for folders in (path)
+        """
+        return {name: date for name, (_, date) in self._list_entries(path).items()}
+
+    @connection_timeout_decorator
+    def get_subfolder_dates(self, path: str) -> dict:
+        """
+        Get dates for folders in (path) only, files are told apart by entry type of the LIST line
+        """
+        return {name: date for name, (is_folder, date) in self._list_entries(path).items() if is_folder}
+
+    def supports_mlsd(self) -> bool:
+        """
+        Check FEAT once per connection
+        """
+        if self._mlsd is None:
+            try:
+                self._mlsd = "MLST" in self.ftp.sendcmd("FEAT").upper()
+            except ftplib.all_errors:
+                self._mlsd = False
+        return self._mlsd
+
+    @connection_timeout_decorator
+    def scan_files(self, path: str) -> dict:
+        """
+        Get {path/name: {"size": int, "modify": datetime}} for files in folder with one MLSD listing
         """
         res = {}
+        for name, facts in self.ftp.mlsd(path, facts=["type", "size", "modify"]):
+            if facts.get("type") != "file" or name.split(".")[-1] not in FILE_EXTENSIONS:
+                continue
+            res[f"{path}/{name}"] = {
+                "size": int(facts["size"]) if "size" in facts else None,
+                "modify": datetime.datetime.strptime(facts["modify"][:14], "%Y%m%d%H%M%S") if "modify" in facts else None,
+            }
+        return res
+
+    def _nlst_files(self, path: str) -> list:
         arr = self.ftp.nlst(path)
-        for file in arr:
-            if file.split(".")[-1] in ["csv", "txt", "xlsx"]:
-                try:
-                    res[file] = self.get_file_date(file)
-                except Exception as e:
-                    logger.debug(f"File - {file} Exception in get file_date - {e}")
+        # some servers answer NLST with bare names, keep keys as full paths like MLSD ones
+        return [file if "/" in file else f"{path}/{file}" for file in arr if file.split(".")[-1] in FILE_EXTENSIONS]
+
+    def _get_dates_for_chunk(self, files: list) -> dict:
+        res = {}
+        for file in files:
+            try:
+                res[file] = self.get_file_date(file)
+            except Exception as e:
+                logger.debug(f"File - {file} Exception in get file_date - {e}")
+        return res
+
+    def _get_dates_parallel(self, files: list, workers: int) -> dict:
+        """
+        Split MDTM calls between this connection and {workers} - 1 extra ones
+        """
+        workers = max(1, min(workers, len(files), self.pool.max_size if self.pool else workers))
+        chunks = [files[i::workers] for i in range(workers)]
+
+        def scan(index):
+            if index == 0:
+                return self._get_dates_for_chunk(chunks[0])
+            with FTPHelper(f"{self.type}://{self.path}", pool=self.pool, **self.credentials) as ftp:
+                return ftp._get_dates_for_chunk(chunks[index])
+
+        res = {}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for chunk_res in executor.map(scan, range(workers)):
+                res.update(chunk_res)
         return res
 
+    @connection_timeout_decorator
+    def get_dates_for_files(self, path: str, workers: int = SCAN_WORKERS) -> dict:
+        """
+        Get datetime for files in folder
+        MLSD listing when server supports it, otherwise MDTM for every file over {workers} connections
+        """
+        if self.supports_mlsd():
+            scanned = self.scan_files(path)
+            if scanned is not None:
+                return {file: facts["modify"] for file, facts in scanned.items()}
+        return self._get_dates_parallel(self._nlst_files(path), workers)
+
     @connection_timeout_decorator
     def get_file_date(self, path: str) -> datetime.datetime:
         raw_data = self.ftp.voidcmd(f"MDTM {path}")
         result = self._parse_date_for_file(raw_data)
         return result
 
-    # def get_file_structure(self, path, level=1):
-    #     print(f"{'  '*level}{path}")
-    #     folders = self.get_folder_content(path)
-    #     for folder in folders:
-    #         if len(folder.split(".")) == 1:
-    #             self.get_file_structure(folder, level+1)
-    #         else:
-    #             print(f"{'  ' * level}  {folder}")
+    @connection_timeout_decorator
+    def list_folder(self, path: str) -> list:
+        """
+        Get [(path/name, is_folder)] for entries of folder, MLSD facts or LIST lines
+        """
+        if self.supports_mlsd():
+            return [
+                (f"{path}/{name}", facts.get("type") == "dir")
+                for name, facts in self.ftp.mlsd(path, facts=["type"])
+                if facts.get("type") in ("dir", "file")
+            ]
+        arr = []
+        self.ftp.retrlines(f"LIST {path}", arr.append)
+        return [(f"{path}/{entry[0]}", entry[1]) for entry in map(parse_list_line, arr) if entry]
+
+    def walk_tree(self, root: str, max_depth: int = None, include: list = None, exclude: list = None,
+                  workers: int = SCAN_WORKERS):
+        """
+        Yield (path, is_folder, depth) for entries under {root} as their folders are listed
+        Folders are listed breadth first over {workers} pooled connections,
+        {exclude} globs skip files and whole folders, {include} globs select files, depth of root entries is 1
+        """
+        def excluded(path):
+            return any(fnmatch.fnmatch(path, pattern) for pattern in exclude or [])
 
+        def included(path):
+            return not include or any(fnmatch.fnmatch(path, pattern) for pattern in include)
 
+        def list_folder(path):
+            with FTPHelper(f"{self.type}://{self.path}", pool=self.pool, **self.credentials) as ftp:
+                return ftp.list_folder(path)
+
+        executor = ThreadPoolExecutor(max_workers=max(1, workers))
+        try:
+            pending = {executor.submit(list_folder, root): 1}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    depth = pending.pop(future)
+                    for path, is_folder in future.result() or []:
+                        if excluded(path):
+                            continue
+                        if is_folder:
+                            yield path, True, depth
+                            if max_depth is None or depth < max_depth:
+                                pending[executor.submit(list_folder, path)] = depth + 1
+                        elif included(path):
+                            yield path, False, depth
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def get_file_structure(self, path, max_depth=None):
+        """
+        Print tree of folder
+        """
+        for entry, is_folder, depth in sorted(self.walk_tree(path, max_depth)):
+            print(f"{'  ' * depth}{entry}")
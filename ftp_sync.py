@@ -0,0 +1,113 @@
+# Stdlib imports
+import datetime
+import json
+import logging
+import os
+
+# Local imports
+from ftp_connection import FTPHelper
+
+logger = logging.getLogger('django')
+
+
+class FTPSync:
+    """
+    Incremental download of csv/txt/xlsx files from FTP tree
+    Should use like
+    with FTPHelper(path, username, password) as ftp:
+        downloaded = FTPSync(ftp, manifest_path, target_dir).sync("/exports")
+    Manifest keeps LIST dates of folders and (size, mtime) of files from the previous run.
+    Every folder is descended into, files are listed only in folders with changed dates
+    and only new or modified files are downloaded.
+    A file rewritten in place does not change its folder date, it is found by a run with {full} True,
+    which lists files of every folder
+    """
+    def __init__(self, ftp: FTPHelper, manifest_path: str, target_dir: str, full: bool = False):
+        self.ftp = ftp
+        self.full = full
+        self.manifest_path = manifest_path
+        self.target_dir = target_dir
+        self.manifest = self._load_manifest()
+
+    def _load_manifest(self) -> dict:
+        if not os.path.exists(self.manifest_path):
+            return {"folders": {}, "files": {}}
+        with open(self.manifest_path, "r") as manifest:
+            return json.load(manifest)
+
+    def _save_manifest(self):
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w") as manifest:
+            json.dump(self.manifest, manifest)
+        os.replace(tmp_path, self.manifest_path)
+
+    @staticmethod
+    def _file_state(facts: dict) -> dict:
+        modify = facts["modify"]
+        return {
+            "size": facts["size"],
+            "modify": modify.isoformat() if isinstance(modify, (datetime.date, datetime.datetime)) else modify,
+        }
+
+    def _local_path(self, remote_path: str) -> str:
+        return os.path.join(self.target_dir, remote_path.lstrip("/"))
+
+    def _download(self, remote_path: str) -> bool:
+        folder, name = remote_path.rsplit("/", 1)
+        local_path = self._local_path(remote_path)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        tmp_path = f"{local_path}.part"
+        size = self.ftp.download_to_file(folder, name, tmp_path, resume=False)
+        if size is None:
+            logger.debug(f"File - {remote_path} was not downloaded")
+            return False
+        os.replace(tmp_path, local_path)
+        return True
+
+    def _sync_files(self, path: str, downloaded: list) -> bool:
+        files = self.ftp.get_files(set(), path)
+        if files is None:
+            return False
+        ok = True
+        for file, facts in files.items():
+            state = self._file_state(facts)
+            if self.manifest["files"].get(file) == state:
+                continue
+            if self._download(file):
+                self.manifest["files"][file] = state
+                downloaded.append(self._local_path(file))
+            else:
+                ok = False
+        return ok
+
+    def _walk(self, path: str, downloaded: list, unchanged: bool = False) -> bool:
+        """
+        Returns False when something in the subtree was not synced.
+        Files of {unchanged} folder are not listed, its subfolders are still walked
+        """
+        ok = unchanged or self._sync_files(path, downloaded)
+        folders = self.ftp.get_subfolder_dates(path)
+        if folders is None:
+            return False
+        today = datetime.date.today()
+        for folder, date in folders.items():
+            # LIST dates have day resolution, folder dated today can change again today
+            folder_unchanged = (not self.full and date < today
+                                and self.manifest["folders"].get(folder) == date.isoformat())
+            if self._walk(folder, downloaded, folder_unchanged):
+                # recorded only after complete walk, so failed or interrupted run lists the folder again
+                self.manifest["folders"][folder] = date.isoformat()
+            else:
+                ok = False
+        return ok
+
+    def sync(self, root: str) -> list:
+        """
+        Download new and modified files under {root}, returns local paths of downloaded files
+        """
+        downloaded = []
+        try:
+            self._walk(root, downloaded)
+        finally:
+            self._save_manifest()
+        return downloaded
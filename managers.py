@@ -0,0 +1,84 @@
+from django.db import models
+from django.db.models import F, FloatField, Value
+from django.db.models.functions import ASin, Cos, Power, Radians, Sin, Sqrt
+import logging
+import math
+
+logger = logging.getLogger('django')
+
+
+miles_per_degree = 69.0
+earth_radius_miles = 3958.761  # same mean radius geopy.distance.great_circle uses
+
+
+class LocationQuerySet(models.QuerySet):
+
+    def within_box(self, lat, long, miles):
+        """
+        Cheap prefilter, served by the (latitude, longitude) index
+        """
+        lat_delta = miles / miles_per_degree
+        long_delta = miles / (miles_per_degree * max(math.cos(math.radians(lat)), 0.01))
+        return self.filter(
+            latitude__range=(lat - lat_delta, lat + lat_delta),
+            longitude__range=(long - long_delta, long + long_delta),
+        )
+
+    def with_distance(self, lat, long):
+        lat_r = Value(math.radians(lat), output_field=FloatField())
+        long_r = Value(math.radians(long), output_field=FloatField())
+        a = Power(Sin((Radians(F('latitude')) - lat_r) / 2), 2) + \
+            math.cos(math.radians(lat)) * Cos(Radians(F('latitude'))) * Power(Sin((Radians(F('longitude')) - long_r) / 2), 2)
+        return self.annotate(distance=Value(2 * earth_radius_miles, output_field=FloatField()) * ASin(Sqrt(a)))
+
+    def nearby(self, lat, long, miles, limit):
+        """
+        Up to {limit} locations within {miles} ordered by distance, everything is done by the database
+        so prefetch_related after it runs only for returned rows
+        """
+        return self.within_box(lat, long, miles)\
+            .with_distance(lat, long)\
+            .filter(distance__lte=miles)\
+            .order_by('distance')[:limit]
+
+
+class GeoLocationMixin(models.Model):
+    """
+    Coordinates for models with an address, filled on save when the address changes.
+    Rows saved before the columns existed are filled by
+    python manage.py backfill_location_coordinates
+    Usage:
+    class Location(GeoLocationMixin, models.Model):
+        ...
+    """
+    latitude = models.FloatField(null=True, blank=True)
+    longitude = models.FloatField(null=True, blank=True)
+
+    objects = LocationQuerySet.as_manager()
+
+    class Meta:
+        abstract = True
+        indexes = [models.Index(fields=['latitude', 'longitude'], name='%(class)s_lat_long_idx')]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # read __dict__ so deferred fields are not loaded here
+        self._geocoded_address = self.__dict__.get('address') if self.__dict__.get('latitude') is not None else None
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if self.address and self.address != self._geocoded_address and \
+                (update_fields is None or 'address' in update_fields):
+            from .helper.destination_helper import submit_geocode
+            try:
+                # shared pool, so saves from many threads share the rate limit and in-flight lookups
+                lat_long = submit_geocode(self.address).result()
+                self._geocoded_address = self.address
+            except Exception as e:
+                # geocoder outage must not block the save, backfill_location_coordinates fills it later
+                logger.warning(f"Geocoding of {self.address} failed - {e}")
+                lat_long = None
+            self.latitude, self.longitude = lat_long if lat_long else (None, None)
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'latitude', 'longitude'}
+        super().save(*args, **kwargs)
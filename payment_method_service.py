@@ -0,0 +1,167 @@
+"""
+Attach card or bank account tokens to tenants' Stripe customers
+Should use like
+payment, created = add_payment_method(tenant, token)
+Card/bank account already attached to the tenant's current customer (same fingerprint) becomes
+the default source again and the existing payment is returned, created is False
+"""
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.exceptions import ValidationError
+from datetime import date
+import logging
+import stripe
+
+from ..models import Payments
+
+logger = logging.getLogger('django')
+
+customer_cache_prefix = 'stripe_customer'
+customer_cache_timeout = getattr(settings, 'STRIPE_CUSTOMER_CACHE_TIMEOUT', 60 * 60 * 24)
+source_lock_timeout = 60
+verify_amounts = [32, 45]
+
+
+def _stripe_error(e: stripe.error.StripeError) -> ValidationError:
+    if getattr(e.error, 'decline_code', None) == 'do_not_honor':
+        return ValidationError(detail={'detail': 'Card declined. '
+                                                 'Please contact your card issuer for more information.'})
+    return ValidationError(detail={'detail': e.user_message or str(e)})
+
+
+def _customer_key(tenant) -> str:
+    return f'{customer_cache_prefix}:{tenant.pk}'
+
+
+def get_customer_id(tenant):
+    """
+    Stripe customer id of tenant, checked against Stripe at most once per {customer_cache_timeout}.
+    None when tenant has no live customer
+    """
+    customer_id = cache.get(_customer_key(tenant))
+    if customer_id and customer_id == tenant.stripe_id:
+        return customer_id
+    if not tenant.stripe_id:
+        return None
+    try:
+        customer = stripe.Customer.retrieve(tenant.stripe_id)
+    except stripe.error.InvalidRequestError:
+        return None
+    except stripe.error.StripeError as e:
+        raise _stripe_error(e)
+    if getattr(customer, 'deleted', False):
+        return None
+    cache.set(_customer_key(tenant), customer.id, timeout=customer_cache_timeout)
+    return customer.id
+
+
+def forget_customer(tenant):
+    cache.delete(_customer_key(tenant))
+
+
+def _token_fingerprint(token) -> str:
+    details = token.get('card') or token.get('bank_account') or {}
+    return details.get('fingerprint')
+
+
+def _attached_payment(tenant, customer_id, fingerprint):
+    """
+    Payment of tenant with {fingerprint} whose source is still attached to {customer_id},
+    rows left from a replaced customer or a detached source are skipped
+    """
+    if not customer_id or not fingerprint:
+        return None
+    for payment in Payments.objects.filter(tenant=tenant, fingerprint=fingerprint).order_by('-id'):
+        if not payment.stripe_id:
+            continue
+        try:
+            stripe.Customer.retrieve_source(customer_id, payment.stripe_id)
+        except stripe.error.InvalidRequestError:
+            continue
+        except stripe.error.StripeError as e:
+            raise _stripe_error(e)
+        return payment
+    return None
+
+
+def _make_default(customer_id, source_id):
+    try:
+        stripe.Customer.modify(customer_id, default_source=source_id)
+    except stripe.error.StripeError as e:
+        raise _stripe_error(e)
+
+
+def _attach_to_new_customer(tenant, token_id):
+    # Customer, source and default source in one call
+    try:
+        customer = stripe.Customer.create(email=tenant.email, source=token_id, expand=['default_source'])
+    except stripe.error.StripeError as e:
+        raise _stripe_error(e)
+    tenant.stripe_id = customer.id
+    tenant.save(update_fields=['stripe_id'])
+    cache.set(_customer_key(tenant), customer.id, timeout=customer_cache_timeout)
+    return customer.default_source
+
+
+def _attach_to_customer(tenant, customer_id, token_id):
+    try:
+        source = stripe.Customer.create_source(customer_id, source=token_id)
+    except stripe.error.InvalidRequestError as e:
+        if getattr(e, 'code', None) != 'resource_missing' or getattr(e, 'param', None) == 'source':
+            raise _stripe_error(e)
+        # Customer deleted on Stripe side since it was cached
+        forget_customer(tenant)
+        return _attach_to_new_customer(tenant, token_id)
+    except stripe.error.StripeError as e:
+        raise _stripe_error(e)
+    _make_default(customer_id, source['id'])
+    return source
+
+
+def _create_payment(tenant, source) -> Payments:
+    try:
+        exp_date = date(year=source.get('exp_year'), month=source.get('exp_month'), day=1)
+    except Exception:
+        exp_date = None
+    return Payments.objects.create(tenant=tenant, stripe_id=source.get('id'), last_4=source.get('last4'),
+                                   card_type=source.get('brand'), expire_date=exp_date,
+                                   fingerprint=source.get('fingerprint'), type=source.get('type'))
+
+
+def add_payment_method(tenant, token_id: str):
+    """
+    Returns (payment, created).
+    Stripe calls: token, then for a new customer one create with the source expanded,
+    for a known customer create_source and default_source update.
+    Known fingerprint takes a source check and the default_source update instead of attaching
+    """
+    try:
+        token = stripe.Token.retrieve(token_id)
+    except stripe.error.StripeError as e:
+        raise _stripe_error(e)
+
+    fingerprint = _token_fingerprint(token)
+    customer_id = get_customer_id(tenant)
+    existing = _attached_payment(tenant, customer_id, fingerprint)
+    if existing:
+        _make_default(customer_id, existing.stripe_id)
+        return existing, False
+
+    # Double submit of the same card must not attach it twice
+    lock_key = f'stripe_source:{tenant.pk}:{fingerprint or token_id}'
+    if not cache.add(lock_key, 1, timeout=source_lock_timeout):
+        raise ValidationError(detail={'detail': 'This payment method is already being added'})
+    try:
+        if customer_id:
+            source = _attach_to_customer(tenant, customer_id, token_id)
+        else:
+            source = _attach_to_new_customer(tenant, token_id)
+
+        if source.get('object') == 'bank_account':
+            try:
+                source.verify(amounts=verify_amounts)
+            except stripe.error.StripeError as e:
+                logger.warning(f'Bank account {source.get("id")} was not verified - {e}')
+        return _create_payment(tenant, source), True
+    finally:
+        cache.delete(lock_key)
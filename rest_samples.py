@@ -1,5 +1,17 @@
 # activities_router.py
 
+def _json_list_response(items) -> Response:
+    # Models come from model_construct, Response skips response_model validating them again
+    content = b"[" + b",".join(item.model_dump_json().encode() for item in items) + b"]"
+    return Response(content=content, media_type="application/json")
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    # Comma separated list or "*", weak comparison as If-None-Match requires
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return "*" in tags or etag in tags
+
+
 @router.get(
     "/participants/{ppmi_id}/events/{event_id}",
     response_model=models.CalendarEventWithActivities,
@@ -8,13 +20,49 @@
 def get_participant_activities(
     ppmi_id: int,
     event_id: int,
+    request: Request,
     category: Optional[str] = Query(None),
     study: Optional[str] = Query(None),
     db: Session = Depends(get_session),
 ):
-    return activity_service.get_participant_activities(
+    cached = activity_service.get_participant_activities_cached(
         db, ppmi_id, event_id, category, study
     )
+    headers = {"ETag": cached.etag, "Cache-Control": "private, no-cache"}
+    if _etag_matches(request.headers.get("if-none-match", ""), cached.etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=cached.body, media_type="application/json", headers=headers)
+
+
+@router.get(
+    "/participants/{ppmi_id}/activities",
+    response_model=models.ParticipantEventsPage,
+    dependencies=[Depends(participants_read_scope)],
+)
+def list_participant_activities(
+    ppmi_id: int,
+    start: Optional[datetime.datetime] = Query(None),
+    end: Optional[datetime.datetime] = Query(None),
+    event_ids: Optional[List[int]] = Query(None),
+    category: Optional[str] = Query(None),
+    study: Optional[str] = Query(None),
+    cursor: Optional[str] = Query(None),
+    limit: int = Query(activity_service.EVENTS_PAGE_SIZE, ge=1, le=activity_service.EVENTS_PAGE_MAX),
+    db: Session = Depends(get_session),
+):
+    try:
+        after = activity_service.decode_events_cursor(cursor) if cursor else None
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+    if not (start or end or event_ids):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="start, end or event_ids is required"
+        )
+    page = activity_service.list_participant_activities(
+        db, ppmi_id, start, end, event_ids, category, study, after, limit
+    )
+    # Response bypasses response_model, which would validate the constructed models again
+    return Response(content=page.model_dump_json(), media_type="application/json")
 
 
 @router.post(
@@ -25,12 +73,87 @@ def get_participant_activities(
 def bulk_create_activity(
     activities: List[models.ActivityCreate], db: Session = Depends(get_session)
 ):
-    return activity_service.bulk_create_activity(db, activities)
+    return _json_list_response(activity_service.bulk_create_activity(db, activities))
+
+
+@router.get(
+    "/async/participants/{ppmi_id}/events/{event_id}",
+    response_model=models.CalendarEventWithActivities,
+    dependencies=[Depends(participants_read_scope)],
+)
+async def get_participant_activities_async(
+    ppmi_id: int,
+    event_id: int,
+    category: Optional[str] = Query(None),
+    study: Optional[str] = Query(None),
+    db: AsyncSession = Depends(get_async_session),
+):
+    event_model = await activity_service.get_participant_activities_async(
+        db, ppmi_id, event_id, category, study
+    )
+    return Response(content=event_model.model_dump_json(), media_type="application/json")
+
+
+@router.post(
+    "/async/bulk_create",
+    response_model=List[models.ActivityResponse],
+    dependencies=[Depends(participants_write_scope)],
+)
+async def bulk_create_activity_async(
+    activities: List[models.ActivityCreate], db: AsyncSession = Depends(get_async_session)
+):
+    return _json_list_response(await activity_service.bulk_create_activity_async(db, activities))
+
+
+def _create_activity_batch(lines: List[bytes], first_line: int):
+    # Own session per batch, dependency sessions are closed before a streaming body runs
+    session = create_session("api")
+    try:
+        return activity_service.bulk_create_activity_lines(session, lines, first_line)
+    finally:
+        session.remove()
+
+
+@router.post(
+    "/bulk_create/stream",
+    dependencies=[Depends(participants_write_scope)],
+)
+async def bulk_create_activity_stream(request: Request):
+    """
+    Newline-delimited ActivityCreate objects in, one result line per committed batch out,
+    "records" are 1-based numbers of non-empty input lines in the batch.
+    Stops at the first invalid batch, batches before it stay committed
+    """
+
+    async def results():
+        first_line = 1
+        async for lines in activity_service.iter_ndjson_batches(request.stream()):
+            result = await run_in_threadpool(_create_activity_batch, lines, first_line)
+            first_line += len(lines)
+            yield json.dumps(result).encode() + b"\n"
+            if "error" in result:
+                break
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+
+
+
+# models.py
+
+
+class ParticipantEventsPage(BaseModel):
+    events: List[CalendarEventWithActivities]
+    next_cursor: Optional[str] = None
 
 
 
 # activity_service
 
+BULK_INSERT_CHUNK_SIZE = 1000  # rows per INSERT statement, keeps bind parameters under driver limits
+STREAM_BATCH_SIZE = 1000  # NDJSON lines validated and committed together
+EVENTS_PAGE_SIZE = 20  # events per page of the participant activity listing
+EVENTS_PAGE_MAX = 100
+
 def get_participant_activities(
     db: Session,
     ppmi_id: int,
@@ -38,129 +161,287 @@ def get_participant_activities(
     category: str | None = None,
     study: str | None = None,
 ):
-    query = (
-        db.query(schemas.CalendarEvent)
-        .join(
-            schemas.ScheduleEvent,
-            schemas.CalendarEvent.schedule_event_id == schemas.ScheduleEvent.id,
-        )
-        .filter(schemas.CalendarEvent.id == event_id)
+    event = _get_participant_event(db, ppmi_id, event_id, category, study)
+    return _build_participant_event(db, event, ppmi_id, event_id)
+
+
+async def get_participant_activities_async(
+    db: AsyncSession,
+    ppmi_id: int,
+    event_id: int,
+    category: str | None = None,
+    study: str | None = None,
+):
+    """
+    Same as get_participant_activities, the two queries are awaited instead of holding a thread
+    """
+    result = await db.execute(_participant_event_statement(event_id, category, study))
+    event = _check_participant_event(result.first(), ppmi_id, event_id)
+    result = await db.execute(
+        _participant_activities_statement(ppmi_id, event_id, event.schedule_event_id)
+    )
+    return _participant_event_model(event, result.all())
+
+
+def get_participant_activities_cached(
+    db: Session,
+    ppmi_id: int,
+    event_id: int,
+    category: str | None = None,
+    study: str | None = None,
+) -> activity_cache.CachedEvent:
+    cached = activity_cache.cache.get_event(ppmi_id, event_id, category, study)
+    if cached is not None:
+        return cached
+
+    event = _get_participant_event(db, ppmi_id, event_id, category, study)
+    # Versions are read before activities, so a change committed meanwhile makes this entry stale
+    versions = activity_cache.cache.versions(event.schedule_event_id, ppmi_id, event_id)
+    event_model = _build_participant_event(db, event, ppmi_id, event_id)
+    return activity_cache.cache.set_event(
+        (ppmi_id, event_id, category, study), event_model, event.schedule_event_id, versions
+    )
+
+
+def _participant_event_statement(
+    event_id: int, category: str | None = None, study: str | None = None
+):
+    statement = _events_statement(category, study).where(schemas.CalendarEvent.id == event_id)
+    return statement.limit(1)
+
+
+def _events_statement(category: str | None = None, study: str | None = None):
+    # Columns only, rows skip the identity map
+    statement = select(
+        schemas.CalendarEvent.id,
+        schemas.CalendarEvent.schedule_event_id,
+        schemas.CalendarEvent.start_time,
+        schemas.CalendarEvent.end_time,
+        schemas.CalendarEvent.status,
+        schemas.ScheduleEvent.title,
+        schemas.ScheduleEvent.description,
+        schemas.ScheduleEvent.category,
+        schemas.ScheduleEvent.study,
+        schemas.ScheduleEvent.event_type,
+    ).join(
+        schemas.ScheduleEvent,
+        schemas.CalendarEvent.schedule_event_id == schemas.ScheduleEvent.id,
     )
 
     if category:
-        query = query.filter(schemas.ScheduleEvent.category == category)
+        statement = statement.where(schemas.ScheduleEvent.category == category)
 
     if study:
-        query = query.filter(schemas.ScheduleEvent.study == study)
+        statement = statement.where(schemas.ScheduleEvent.study == study)
 
-    event = query.first()
+    return statement
 
-    if event is None:
-        raise errors.NotFoundException(
-            f"Event not found for participant {ppmi_id} with event_id {event_id}"
-        )
 
-    activities = (
-        db.query(schemas.Activity)
-        .options(
-            joinedload(schemas.Activity.activity_statuses)
-        )  # Eager load activity statuses
-        .filter(schemas.Activity.schedule_event_id == event.schedule_event_id)
-        .all()
-    )
+# In ActivityWithStatus field order
+activity_columns = (
+    schemas.Activity.id,
+    schemas.Activity.name,
+    schemas.Activity.description,
+    schemas.Activity.type,
+    schemas.Activity.related_entity_id,
+    schemas.ParticipantActivityStatus.related_entity_version,
+    schemas.ParticipantActivityStatus.status,
+    schemas.Link.url,
+)
+
 
-    participant_statuses = (
-        db.query(schemas.ParticipantActivityStatus)
-        .filter(
+def _with_status_and_link(statement, ppmi_id: int, calendar_event_id):
+    # Participant's status and link url joined in, activities without them are kept
+    return statement.outerjoin(
+        schemas.ParticipantActivityStatus,
+        and_(
+            schemas.ParticipantActivityStatus.activity_id == schemas.Activity.id,
             schemas.ParticipantActivityStatus.ppmi_id == ppmi_id,
-            schemas.ParticipantActivityStatus.calendar_event_id == event_id,
-            schemas.ParticipantActivityStatus.activity_id.in_(
-                [activity.id for activity in activities]
-            ),
-        )
-        .all()
+            schemas.ParticipantActivityStatus.calendar_event_id == calendar_event_id,
+        ),
+    ).outerjoin(
+        schemas.Link,
+        and_(
+            schemas.Activity.type == enums.ActivityTypeEnum.link,
+            schemas.Link.id == schemas.Activity.related_entity_id,
+        ),
+    )
+
+
+def _participant_activities_statement(ppmi_id: int, event_id: int, schedule_event_id: int):
+    # Activities with the participant's status and link url in one round trip
+    return _with_status_and_link(select(*activity_columns), ppmi_id, event_id).where(
+        schemas.Activity.schedule_event_id == schedule_event_id
     )
 
-    status_lookup = {status.activity_id: status for status in participant_statuses}
-
-    links = (
-        db.query(schemas.Link)
-        .filter(
-            schemas.Link.id.in_(
-                [
-                    activity.related_entity_id
-                    for activity in activities
-                    if activity.type == enums.ActivityTypeEnum.link
-                ]
-            ),
+
+def _events_activities_statement(ppmi_id: int, event_ids: List[int]):
+    # Activities of many calendar events at once, event id first in every row
+    statement = select(schemas.CalendarEvent.id, *activity_columns).join(
+        schemas.Activity,
+        schemas.Activity.schedule_event_id == schemas.CalendarEvent.schedule_event_id,
+    )
+    return _with_status_and_link(statement, ppmi_id, schemas.CalendarEvent.id).where(
+        schemas.CalendarEvent.id.in_(event_ids)
+    )
+
+
+def encode_events_cursor(start_time: datetime.datetime, event_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([start_time.isoformat(), event_id]).encode()).decode()
+
+
+def decode_events_cursor(cursor: str) -> tuple:
+    """
+    Raises ValueError for a cursor that was not made by encode_events_cursor
+    """
+    try:
+        start_time, event_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.datetime.fromisoformat(start_time), int(event_id)
+    except (TypeError, ValueError, binascii.Error) as e:
+        raise ValueError(f"Invalid cursor {cursor}") from e
+
+
+def list_participant_activities(
+    db: Session,
+    ppmi_id: int,
+    start: datetime.datetime | None = None,
+    end: datetime.datetime | None = None,
+    event_ids: List[int] | None = None,
+    category: str | None = None,
+    study: str | None = None,
+    after: tuple | None = None,
+    limit: int = EVENTS_PAGE_SIZE,
+) -> models.ParticipantEventsPage:
+    """
+    Participant's events starting in [start, end) and/or from {event_ids}, ordered by (start_time, id),
+    with the participant's activities. At least one of the filters is required.
+    Events belong to the participant through their ParticipantActivityStatus rows, events where
+    the participant has no status yet are not listed, nor are events without start_time.
+    Keyset pagination, {after} is the decoded cursor of the previous page.
+    Two queries per page whatever the number of events
+    """
+    if not (start or end or event_ids):
+        raise ValueError("start, end or event_ids is required")
+
+    participant_statuses = select(schemas.ParticipantActivityStatus.id).where(
+        schemas.ParticipantActivityStatus.calendar_event_id == schemas.CalendarEvent.id,
+        schemas.ParticipantActivityStatus.ppmi_id == ppmi_id,
+    )
+    statement = _events_statement(category, study).where(
+        schemas.CalendarEvent.start_time.isnot(None), participant_statuses.exists()
+    )
+    if start:
+        statement = statement.where(schemas.CalendarEvent.start_time >= start)
+    if end:
+        statement = statement.where(schemas.CalendarEvent.start_time < end)
+    if event_ids:
+        statement = statement.where(schemas.CalendarEvent.id.in_(event_ids))
+    if after:
+        statement = statement.where(
+            tuple_(schemas.CalendarEvent.start_time, schemas.CalendarEvent.id) > tuple_(*after)
         )
-        .all()
+    events = db.execute(
+        statement.order_by(schemas.CalendarEvent.start_time, schemas.CalendarEvent.id).limit(limit + 1)
+    ).all()
+
+    next_cursor = None
+    if len(events) > limit:
+        events = events[:limit]
+        next_cursor = encode_events_cursor(events[-1].start_time, events[-1].id)
+
+    rows_by_event = {event.id: [] for event in events}
+    if events:
+        for row in db.execute(_events_activities_statement(ppmi_id, list(rows_by_event))):
+            rows_by_event[row[0]].append(row[1:])
+
+    return models.ParticipantEventsPage.model_construct(
+        events=[_participant_event_model(event, rows_by_event[event.id]) for event in events],
+        next_cursor=next_cursor,
     )
 
-    links_lookup = {link.id: link.url for link in links}
 
-    activity_models = []
-    for activity in activities:
-        activity_status = status_lookup.get(activity.id)
-
-        activity_model = models.ActivityWithStatus(
-            activity_id=activity.id,
-            name=activity.name,
-            description=activity.description,
-            type=activity.type,
-            related_entity_id=activity.related_entity_id,
-            related_entity_version=(
-                activity_status.related_entity_version if activity_status else None
-            ),
-            status=(activity_status.status if activity_status else None),
-            link_url=(
-                links_lookup.get(activity.related_entity_id)
-                if activity.type == enums.ActivityTypeEnum.link
-                else None
-            ),
+def _check_participant_event(event, ppmi_id: int, event_id: int):
+    if event is None:
+        raise errors.NotFoundException(
+            f"Event not found for participant {ppmi_id} with event_id {event_id}"
         )
-        activity_models.append(activity_model)
 
-    event_model = models.CalendarEventWithActivities(
+    return event
+
+
+def _get_participant_event(
+    db: Session,
+    ppmi_id: int,
+    event_id: int,
+    category: str | None = None,
+    study: str | None = None,
+):
+    event = db.execute(_participant_event_statement(event_id, category, study)).first()
+    return _check_participant_event(event, ppmi_id, event_id)
+
+
+def _build_participant_event(db: Session, event, ppmi_id: int, event_id: int):
+    rows = db.execute(
+        _participant_activities_statement(ppmi_id, event_id, event.schedule_event_id)
+    ).all()
+    return _participant_event_model(event, rows)
+
+
+def _participant_event_model(event, rows):
+    """
+    Rows come straight from the database with declared types, so models are built without validation
+    """
+    # One entry per activity, the last status wins as in a lookup by activity_id
+    activity_rows = {row[0]: row for row in rows}
+
+    activity_models = [
+        models.ActivityWithStatus.model_construct(
+            activity_id=activity_id,
+            name=name,
+            description=description,
+            type=activity_type,
+            related_entity_id=related_entity_id,
+            related_entity_version=related_entity_version,
+            status=activity_status,
+            link_url=link_url,
+        )
+        for (
+            activity_id,
+            name,
+            description,
+            activity_type,
+            related_entity_id,
+            related_entity_version,
+            activity_status,
+            link_url,
+        ) in activity_rows.values()
+    ]
+
+    event_model = models.CalendarEventWithActivities.model_construct(
         event_id=event.id,
-        title=event.schedule_event.title,
+        title=event.title,
         start_time=event.start_time,
         end_time=event.end_time,
-        description=event.schedule_event.description,
-        category=event.schedule_event.category,
+        description=event.description,
+        category=event.category,
         status=event.status,
         activities=activity_models,
-        study=event.schedule_event.study,
-        event_type=event.schedule_event.event_type,
+        study=event.study,
+        event_type=event.event_type,
     )
 
     return event_model
 
 
-def bulk_create_activity(db: Session, activities: List[models.ActivityCreate]):
-
+def _related_id_map(activities: List[models.ActivityCreate]) -> dict:
     type_to_ids = {}
     for activity in activities:
-        type_to_ids.setdefault(activity.type, set()).add(activity.related_entity_id)
-
-    # Query all relevant tables in a single batch query
-    valid_ids = {}
-
-    if enums.ActivityTypeEnum.survey in type_to_ids:
-        valid_ids[enums.ActivityTypeEnum.survey] = {
-            row[0]
-            for row in db.query(schemas.Survey.id)
-            .filter(schemas.Survey.id.in_(type_to_ids[enums.ActivityTypeEnum.survey]))
-            .all()
-        }
-    if enums.ActivityTypeEnum.link in type_to_ids:
-        valid_ids[enums.ActivityTypeEnum.link] = {
-            row[0]
-            for row in db.query(schemas.Link.id)
-            .filter(schemas.Link.id.in_(type_to_ids[enums.ActivityTypeEnum.link]))
-            .all()
-        }
+        if activity.related_entity_id:
+            type_to_ids.setdefault(activity.type, set()).add(activity.related_entity_id)
+    return type_to_ids
+
 
+def _check_related_ids(activities: List[models.ActivityCreate], valid_ids: dict):
     # Validate all activities before insertion
     for activity in activities:
         if (
@@ -171,62 +452,595 @@ def bulk_create_activity(db: Session, activities: List[models.ActivityCreate]):
                 error=f"Invalid related_entity_id {activity.related_entity_id} for type {activity.type}"
             )
 
-    db_activities = [
-        schemas.Activity(**activity.model_dump()) for activity in activities
-    ]
-    db.add_all(db_activities)
+
+# Multi-row INSERT ... RETURNING, ids come back without a SELECT per row
+activity_insert_statement = insert(schemas.Activity).returning(
+    schemas.Activity.id,
+    schemas.Activity.name,
+    schemas.Activity.description,
+    schemas.Activity.type,
+    schemas.Activity.related_entity_id,
+    schemas.Activity.schedule_event_id,
+    sort_by_parameter_order=True,
+)
+
+
+def _activity_row_chunks(activities: List[models.ActivityCreate]):
+    rows = [activity.model_dump() for activity in activities]
+    for start in range(0, len(rows), BULK_INSERT_CHUNK_SIZE):
+        yield rows[start : start + BULK_INSERT_CHUNK_SIZE]
+
+
+def _created_activities(activities: List[models.ActivityCreate], created):
+    activity_cache.cache.invalidate_schedule_events(
+        {activity.schedule_event_id for activity in activities}
+    )
+    # RETURNING rows carry the inserted values, nothing left to validate
+    return [models.ActivityResponse.model_construct(**row._asdict()) for row in created]
+
+
+def bulk_create_activity(db: Session, activities: List[models.ActivityCreate]):
+    # All types in one UNION query, ids seen recently come from the registry cache
+    valid_ids, statement = related_entities.registry.lookup(_related_id_map(activities))
+    if statement is not None:
+        related_entities.registry.record(valid_ids, db.execute(statement))
+    _check_related_ids(activities, valid_ids)
+
+    created = []
+    for rows in _activity_row_chunks(activities):
+        created.extend(db.execute(activity_insert_statement, rows).all())
     db.commit()
 
-    for activity in db_activities:
-        db.refresh(activity)
-
-    return [
-        models.ActivityResponse(
-            id=db_activity.id,
-            name=db_activity.name,
-            description=db_activity.description,
-            type=db_activity.type,
-            related_entity_id=db_activity.related_entity_id,
-            schedule_event_id=db_activity.schedule_event_id,
+    return _created_activities(activities, created)
+
+
+async def bulk_create_activity_async(db: AsyncSession, activities: List[models.ActivityCreate]):
+    valid_ids, statement = related_entities.registry.lookup(_related_id_map(activities))
+    if statement is not None:
+        related_entities.registry.record(valid_ids, await db.execute(statement))
+    _check_related_ids(activities, valid_ids)
+
+    created = []
+    for rows in _activity_row_chunks(activities):
+        created.extend((await db.execute(activity_insert_statement, rows)).all())
+    await db.commit()
+
+    return _created_activities(activities, created)
+
+
+async def iter_ndjson_batches(
+    chunks: AsyncIterator[bytes], batch_size: int = STREAM_BATCH_SIZE
+) -> AsyncIterator[List[bytes]]:
+    """
+    Split body chunks into lines and group them, memory holds one batch at a time
+    """
+    buffer = b""
+    batch = []
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                batch.append(line)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+    if buffer.strip():
+        batch.append(buffer)
+    if batch:
+        yield batch
+
+
+def bulk_create_activity_lines(db: Session, lines: List[bytes], first_line: int = 1):
+    """
+    Validate and create one batch of NDJSON activities, related ids are checked once per batch
+    """
+    activities = []
+    for number, line in enumerate(lines, start=first_line):
+        try:
+            activities.append(models.ActivityCreate.model_validate_json(line))
+        except ValidationError as e:
+            return {"records": [first_line, first_line + len(lines) - 1], "error": f"record {number}: {e}"}
+
+    try:
+        created = bulk_create_activity(db, activities)
+    except errors.NotFoundException as e:
+        db.rollback()
+        return {"records": [first_line, first_line + len(lines) - 1], "error": str(e)}
+    except sqlalchemy_exc.SQLAlchemyError as e:
+        # e.g. unknown schedule_event_id, reported as a line instead of breaking the stream
+        db.rollback()
+        return {"records": [first_line, first_line + len(lines) - 1], "error": str(getattr(e, "orig", None) or e)}
+
+    return {
+        "records": [first_line, first_line + len(lines) - 1],
+        "created": [activity.model_dump(mode="json") for activity in created],
+    }
+
+
+# activity_cache.py
+from abc import ABC, abstractmethod
+import itertools
+
+
+class CachedEvent(NamedTuple):
+    body: bytes
+    etag: str
+    schedule_event_id: int
+    versions: tuple
+
+
+class CacheBackend(ABC):
+    """
+    Storage of activity_cache: expiring entries and integer versions that never expire
+    """
+
+    @abstractmethod
+    def get(self, key: str):
+        ...
+
+    @abstractmethod
+    def set(self, key: str, value, ttl: int):
+        ...
+
+    @abstractmethod
+    def get_versions(self, keys: list) -> list:
+        ...
+
+    @abstractmethod
+    def incr(self, key: str):
+        ...
+
+    @abstractmethod
+    def delete(self, key: str):
+        ...
+
+    def get_many(self, keys: list) -> list:
+        return [self.get(key) for key in keys]
+
+
+# One sequence for every LRUCacheBackend of the process, a version value is never handed out twice
+_version_counter = itertools.count(1)
+
+
+class LRUCacheBackend(CacheBackend):
+    """
+    In-process backend, every worker keeps its own entries and versions.
+    Invalidation reaches only the worker that committed, so it is correct only with a single worker,
+    with more use RedisCacheBackend or other workers serve stale bodies and 304s for up to the ttl.
+    Versions are kept apart from LRU entries and drawn from _version_counter, so a value is never reused.
+    Over {max_versions} the oldest bumped half is dropped and dropped keys read as a new floor value,
+    which no cached entry was built with, so pruning can't bring stale entries back
+    """
+
+    def __init__(self, maxsize: int = 1024, max_versions: int = 100_000):
+        self.maxsize = maxsize
+        self.max_versions = max_versions
+        self._data = OrderedDict()
+        self._versions = OrderedDict()  # key -> version, oldest bump first
+        self._floor = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[1] < time.monotonic():
+                return None
+            self._data.move_to_end(key)
+            return item[0]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get_versions(self, keys):
+        with self._lock:
+            return [self._versions.get(key, self._floor) for key in keys]
+
+    def incr(self, key):
+        with self._lock:
+            self._versions.pop(key, None)
+            self._versions[key] = next(_version_counter)
+            if len(self._versions) > self.max_versions:
+                self._floor = next(_version_counter)
+                while len(self._versions) > self.max_versions // 2:
+                    self._versions.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+
+class RedisCacheBackend(CacheBackend):
+    """
+    Shared backend, entries and versions are seen by every worker
+    """
+
+    def __init__(self, client, prefix: str = "activity_cache:"):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return pickle.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, pickle.dumps(value), ex=ttl)
+
+    def get_versions(self, keys):
+        return [int(value or 0) for value in self.client.mget([self.prefix + key for key in keys])]
+
+    def incr(self, key):
+        self.client.incr(self.prefix + key)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def get_many(self, keys):
+        values = self.client.mget([self.prefix + key for key in keys]) if keys else []
+        return [pickle.loads(value) if value is not None else None for value in values]
+
+
+class ActivityCache:
+    """
+    Participant calendar event responses keyed by (ppmi_id, event_id, category, study)
+    An entry remembers versions of its schedule event and of the participant's statuses for the event,
+    bumping either version invalidates every entry built from it
+    """
+
+    def __init__(self, backend: CacheBackend, ttl: int = 300):
+        self.backend = backend
+        self.ttl = ttl
+
+    @staticmethod
+    def _schedule_key(schedule_event_id):
+        return f"version:schedule:{schedule_event_id}"
+
+    @staticmethod
+    def _status_key(ppmi_id, event_id):
+        return f"version:status:{ppmi_id}:{event_id}"
+
+    def versions(self, schedule_event_id: int, ppmi_id: int, event_id: int) -> tuple:
+        return tuple(
+            self.backend.get_versions(
+                [self._schedule_key(schedule_event_id), self._status_key(ppmi_id, event_id)]
+            )
         )
-        for db_activity in db_activities
-    ]
+
+    def get_event(self, ppmi_id, event_id, category, study) -> CachedEvent | None:
+        cached = self.backend.get(f"event:{ppmi_id}:{event_id}:{category}:{study}")
+        if cached is None:
+            return None
+        if self.versions(cached.schedule_event_id, ppmi_id, event_id) != cached.versions:
+            return None
+        return cached
+
+    def set_event(self, key: tuple, event_model, schedule_event_id: int, versions: tuple) -> CachedEvent:
+        body = event_model.model_dump_json().encode()
+        cached = CachedEvent(body, f'"{hashlib.sha1(body).hexdigest()}"', schedule_event_id, versions)
+        self.backend.set("event:{}:{}:{}:{}".format(*key), cached, self.ttl)
+        return cached
+
+    def invalidate_schedule_events(self, schedule_event_ids):
+        for schedule_event_id in schedule_event_ids:
+            self.backend.incr(self._schedule_key(schedule_event_id))
+
+    def invalidate_participant_event(self, ppmi_id: int, event_id: int):
+        self.backend.incr(self._status_key(ppmi_id, event_id))
+
+
+cache = ActivityCache(LRUCacheBackend())
+
+
+def configure(backend: CacheBackend, ttl: int = 300):
+    """
+    Switch to a shared backend on startup, e.g. configure(RedisCacheBackend(redis.Redis.from_url(url))).
+    Required when the API runs more than one worker process, see LRUCacheBackend
+    """
+    global cache
+    cache = ActivityCache(backend, ttl)
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_invalidations(session, flush_context):
+    pending = session.info.setdefault("activity_cache_invalidations", set())
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, schemas.Activity):
+            pending.add(("schedule", obj.schedule_event_id))
+        elif isinstance(obj, schemas.ParticipantActivityStatus):
+            pending.add(("status", obj.ppmi_id, obj.calendar_event_id))
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_invalidations(session):
+    # after commit, so nobody can cache the old rows under the new version
+    for kind, *ids in session.info.pop("activity_cache_invalidations", ()):
+        if kind == "schedule":
+            cache.invalidate_schedule_events(ids)
+        else:
+            cache.invalidate_participant_event(*ids)
+
+
+@event.listens_for(Session, "after_rollback")
+def _drop_invalidations(session):
+    session.info.pop("activity_cache_invalidations", None)
+
+
+# related_entities.py
+from activity_cache import CacheBackend, LRUCacheBackend
+
+
+class RelatedEntityRegistry:
+    """
+    Where related_entity_id of each activity type points to.
+    Types registered without a column, and types never registered, take no related entity,
+    so any id given for them is invalid.
+    Ids found are kept in {backend} for {ttl} seconds, repeated imports of the same surveys and links
+    skip the query. Ids not found are not cached, an entity created a moment ago is found on the next call.
+    Default backend is per process, pass the RedisCacheBackend given to activity_cache.configure
+    when forget() has to reach every worker
+    """
+
+    def __init__(self, backend: CacheBackend | None = None, ttl: int = 60, maxsize: int = 100_000):
+        self.columns = {}
+        self.backend = backend or LRUCacheBackend(maxsize=maxsize)
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(activity_type: enums.ActivityTypeEnum, related_id) -> str:
+        return f"related:{activity_type.value}:{related_id}"
+
+    def register(self, activity_type: enums.ActivityTypeEnum, id_column=None):
+        self.columns[activity_type] = id_column
+
+    def lookup(self, type_to_ids: dict):
+        """
+        Returns ids known to exist per type and one UNION statement for the rest,
+        statement is None when the cache answered everything
+        """
+        valid_ids = {}
+        statements = []
+        for activity_type, ids in type_to_ids.items():
+            valid = valid_ids.setdefault(activity_type, set())
+            unknown = set()
+            ids = list(ids)
+            cached = self.backend.get_many([self._key(activity_type, related_id) for related_id in ids])
+            for related_id, found in zip(ids, cached):
+                if found:
+                    valid.add(related_id)
+                else:
+                    unknown.add(related_id)
+            id_column = self.columns.get(activity_type)
+            if unknown and id_column is not None:
+                statements.append(
+                    select(literal(activity_type.value).label("type"), id_column.label("id"))
+                    .where(id_column.in_(unknown))
+                )
+
+        if not statements:
+            return valid_ids, None
+        return valid_ids, statements[0] if len(statements) == 1 else union_all(*statements)
+
+    def record(self, valid_ids: dict, rows) -> dict:
+        for activity_type, related_id in rows:
+            activity_type = enums.ActivityTypeEnum(activity_type)
+            valid_ids.setdefault(activity_type, set()).add(related_id)
+            self.backend.set(self._key(activity_type, related_id), True, self.ttl)
+        return valid_ids
+
+    def forget(self, activity_type: enums.ActivityTypeEnum, related_ids):
+        # For deletes of surveys or links, otherwise they stay valid until the ttl runs out
+        for related_id in related_ids:
+            self.backend.delete(self._key(activity_type, related_id))
+
+
+registry = RelatedEntityRegistry()
+registry.register(enums.ActivityTypeEnum.survey, schemas.Survey.id)
+registry.register(enums.ActivityTypeEnum.link, schemas.Link.id)
+
+
+# config.py
+
+# Fields added to Settings (pydantic BaseSettings), set by DB_POOL_SIZE etc. env vars
+
+
+class Settings(BaseSettings):
+    ...
+    db_pool_size: int = 20
+    db_max_overflow: int = 30
+    db_pool_timeout: int = 30  # seconds a checkout waits before TimeoutError
+    db_pool_recycle: int = 1800  # seconds, reconnect before server side idle timeouts
+    async_database_driver: str | None = None  # e.g. postgresql+asyncpg, enables get_async_session
 
 
 # database session and dependency session.py
 
 
+class PoolMetrics:
+    """
+    Counters of one engine pool, read with pool_metrics()
+    """
+
+    def __init__(self):
+        self.checkouts = 0
+        self.connects = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.connect_seconds = 0.0
+        self.timeouts = 0
+        self.lock = threading.Lock()
+
+
+class MeteredQueuePool(QueuePool):
+    """
+    QueuePool that measures how long checkouts wait for a free connection.
+    Opening a new connection is timed apart, it is not contention for the pool
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+        self._checkout = threading.local()
+
+    def _create_connection(self):
+        started = time.perf_counter()
+        try:
+            return super()._create_connection()
+        finally:
+            connecting = time.perf_counter() - started
+            self._checkout.connect_seconds = getattr(self._checkout, "connect_seconds", 0.0) + connecting
+            with self.metrics.lock:
+                self.metrics.connect_seconds += connecting
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+    def _do_get(self):
+        self._checkout.connect_seconds = 0.0
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except sqlalchemy_exc.TimeoutError:
+            with self.metrics.lock:
+                self.metrics.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - started - self._checkout.connect_seconds
+            with self.metrics.lock:
+                self.metrics.checkouts += 1
+                if waited > 0.001:
+                    self.metrics.waits += 1
+                self.metrics.wait_seconds += waited
+                self.metrics.max_wait_seconds = max(self.metrics.max_wait_seconds, waited)
+
+
+settings = get_settings()
+
 database_urls = {
-    "api": get_settings().database_url.unicode_string(),
+    "api": settings.database_url.unicode_string(),
 }
 
 engines = {
     "api": create_engine(
         database_urls["api"],
+        poolclass=MeteredQueuePool,
         pool_pre_ping=True,
-        pool_size=20,  # Adjusted pool size for local testing
-        max_overflow=30,
+        pool_size=settings.db_pool_size,
+        max_overflow=settings.db_max_overflow,
+        pool_timeout=settings.db_pool_timeout,
+        pool_recycle=settings.db_pool_recycle,
     ),
 }
 
+# Created once per engine, not per request
+session_factories = {
+    name: sessionmaker(bind=engine, autoflush=False) for name, engine in engines.items()
+}
+scoped_sessions = {
+    name: scoped_session(factory) for name, factory in session_factories.items()
+}
+
+
+def _count_connects(engine):
+    def count(dbapi_connection, connection_record):
+        with engine.pool.metrics.lock:
+            engine.pool.metrics.connects += 1
+
+    event.listen(engine, "connect", count)
+
+
+for _engine in engines.values():
+    _count_connects(_engine)
+
+
+def pool_metrics() -> dict:
+    """
+    Pool state and counters per engine, to size pool_size/max_overflow against real concurrency
+    """
+    result = {}
+    for name, engine in engines.items():
+        pool = engine.pool
+        metrics = pool.metrics
+        with metrics.lock:
+            result[name] = {
+                "size": pool.size(),
+                "checked_out": pool.checkedout(),
+                "overflow": max(pool.overflow(), 0),
+                "checkouts": metrics.checkouts,
+                "connects": metrics.connects,
+                "waits": metrics.waits,
+                "wait_seconds": round(metrics.wait_seconds, 6),
+                "max_wait_seconds": round(metrics.max_wait_seconds, 6),
+                "connect_seconds": round(metrics.connect_seconds, 6),
+                "timeouts": metrics.timeouts,
+            }
+    return result
+
 
 def create_session(db: str = "api") -> scoped_session:
     match db:
         case "api":
-            engine = engines["api"]
+            return scoped_sessions["api"]
         case other:
             raise Exception(f"Database {other} doesn't exist")
 
-    session = scoped_session(sessionmaker(bind=engine, autoflush=False))
-    return session
-
 
 # Dependency
-def get_session() -> Generator[scoped_session, None, None]:
-    session = create_session("api")
+def get_session() -> Generator[Session, None, None]:
+    # Plain session, FastAPI may run the dependency and the route in different threadpool threads
+    session = session_factories["api"]()
     try:
         yield session
     finally:
-        session.remove()
+        session.close()
+
+
+def _async_url(url: str, driver: str) -> str:
+    # Same database through an asyncio driver
+    return make_url(url).set(drivername=driver).render_as_string(hide_password=False)
 
 
+# Created on first use, only when settings.async_database_driver is set,
+# so the sync stack imports and runs without asyncpg/greenlet or on another database
+async_engines = {}
+async_session_factories = {}
+_async_lock = threading.Lock()
+
+
+def get_async_session_factory(db: str = "api"):
+    factory = async_session_factories.get(db)
+    if factory is not None:
+        return factory
+    if db not in database_urls:
+        raise Exception(f"Database {db} doesn't exist")
+    if not settings.async_database_driver:
+        raise RuntimeError("Async database access needs ASYNC_DATABASE_DRIVER, e.g. postgresql+asyncpg")
+    from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+    with _async_lock:
+        if db not in async_session_factories:
+            engine = create_async_engine(
+                _async_url(database_urls[db], settings.async_database_driver),
+                pool_pre_ping=True,
+                pool_size=settings.db_pool_size,
+                max_overflow=settings.db_max_overflow,
+                pool_timeout=settings.db_pool_timeout,
+                pool_recycle=settings.db_pool_recycle,
+            )
+            async_engines[db] = engine
+            async_session_factories[db] = async_sessionmaker(
+                engine, autoflush=False, expire_on_commit=False
+            )
+    return async_session_factories[db]
+
+
+# Async dependency, for routes declared with async def
+async def get_async_session() -> AsyncGenerator["AsyncSession", None]:
+    async with get_async_session_factory("api")() as session:
+        yield session
@@ -0,0 +1,19 @@
+"""
+Management command, lives in management/commands/ of the app
+Submits Calendly jobs left pending by a stopped or restarted process and waits for them.
+Run from cron, e.g. every 10 minutes:
+    python manage.py resume_calendly_jobs
+Safe to run while web workers process jobs, a job is run by one worker at a time
+"""
+from django.core.management.base import BaseCommand
+
+from ...helper import calendly_jobs
+
+
+class Command(BaseCommand):
+    help = 'Run Calendly webhook jobs that are still pending'
+
+    def handle(self, *args, **options):
+        count = calendly_jobs.resume_pending()
+        calendly_jobs.executor.shutdown(wait=True)
+        self.stdout.write(f'Submitted {count} pending Calendly jobs')
@@ -0,0 +1,155 @@
+import datetime
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+import activity_cache
+import activity_service
+import enums
+import errors
+import models
+import related_entities
+import schemas
+
+
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://")
+    schemas.Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine, autoflush=False)()
+    yield session
+    session.close()
+
+
+@pytest.fixture
+def calendar_event(db):
+    # pylint: disable=redefined-outer-name
+    schedule_event = schemas.ScheduleEvent(id=1, title="Visit", description="d", category="visit",
+                                           study="ppmi", event_type="onsite")
+    event_row = schemas.CalendarEvent(id=10, schedule_event_id=1, status="scheduled")
+    db.add_all([
+        schedule_event,
+        event_row,
+        schemas.Link(id=5, url="https://abc.com/form"),
+        schemas.Activity(id=1, name="survey", type=enums.ActivityTypeEnum.survey,
+                         related_entity_id=3, schedule_event_id=1),
+        schemas.Activity(id=2, name="link", type=enums.ActivityTypeEnum.link,
+                         related_entity_id=5, schedule_event_id=1),
+        schemas.Activity(id=3, name="no status", type=enums.ActivityTypeEnum.survey,
+                         related_entity_id=5, schedule_event_id=1),
+        schemas.ParticipantActivityStatus(ppmi_id=7, calendar_event_id=10, activity_id=1,
+                                          status="completed", related_entity_version="v2"),
+        # another participant, must not leak into the response
+        schemas.ParticipantActivityStatus(ppmi_id=8, calendar_event_id=10, activity_id=2, status="completed"),
+    ])
+    db.commit()
+    db.expunge_all()
+    return event_row
+
+
+def count_queries(db):
+    statements = []
+    event.listen(db.get_bind(), "before_cursor_execute",
+                 lambda conn, cursor, statement, *args: statements.append(statement))
+    return statements
+
+
+# pylint: disable=redefined-outer-name,unused-argument
+def test_get_participant_activities_query_count(db, calendar_event):
+    statements = count_queries(db)
+
+    result = activity_service.get_participant_activities(db, 7, 10)
+
+    assert len(statements) <= 2
+    assert result.title == "Visit"
+    activities = {activity.activity_id: activity for activity in result.activities}
+    assert activities[1].status == "completed"
+    assert activities[1].related_entity_version == "v2"
+    assert activities[2].status is None
+    assert activities[2].link_url == "https://abc.com/form"
+    # survey pointing to the same id as a link gets no url
+    assert activities[3].link_url is None
+
+
+def test_get_participant_activities_filters(db, calendar_event):
+    with pytest.raises(errors.NotFoundException):
+        activity_service.get_participant_activities(db, 7, 10, category="other")
+
+
+def test_cached_event_invalidation(db, calendar_event, monkeypatch):
+    monkeypatch.setattr(activity_cache, "cache", activity_cache.ActivityCache(activity_cache.LRUCacheBackend()))
+    first = activity_service.get_participant_activities_cached(db, 7, 10)
+    statements = count_queries(db)
+
+    assert activity_service.get_participant_activities_cached(db, 7, 10) == first
+    assert not statements
+
+    activity_service.bulk_create_activity(db, [
+        models.ActivityCreate(name="new", type=enums.ActivityTypeEnum.link, related_entity_id=5, schedule_event_id=1),
+    ])
+    second = activity_service.get_participant_activities_cached(db, 7, 10)
+    assert second.etag != first.etag
+
+    status = db.query(schemas.ParticipantActivityStatus).filter_by(ppmi_id=7).one()
+    status.status = "in_progress"
+    db.commit()
+    assert b"in_progress" in activity_service.get_participant_activities_cached(db, 7, 10).body
+
+
+def test_related_entities_checked_in_one_query(db, calendar_event, monkeypatch):
+    monkeypatch.setattr(related_entities, "registry", related_entities.RelatedEntityRegistry())
+    related_entities.registry.register(enums.ActivityTypeEnum.survey, schemas.Survey.id)
+    related_entities.registry.register(enums.ActivityTypeEnum.link, schemas.Link.id)
+    db.add(schemas.Survey(id=3))
+    db.commit()
+    activities = [
+        models.ActivityCreate(name="survey", type=enums.ActivityTypeEnum.survey, related_entity_id=3, schedule_event_id=1),
+        models.ActivityCreate(name="link", type=enums.ActivityTypeEnum.link, related_entity_id=5, schedule_event_id=1),
+    ]
+    statements = count_queries(db)
+
+    activity_service.bulk_create_activity(db, activities)
+    assert len([s for s in statements if s.lstrip().upper().startswith("SELECT")]) == 1
+
+    statements.clear()
+    activity_service.bulk_create_activity(db, activities)
+    assert not [s for s in statements if s.lstrip().upper().startswith("SELECT")]
+
+    with pytest.raises(errors.NotFoundException):
+        activity_service.bulk_create_activity(db, [
+            models.ActivityCreate(name="survey", type=enums.ActivityTypeEnum.survey, related_entity_id=5, schedule_event_id=1),
+        ])
+
+
+def test_list_participant_activities_pages(db, calendar_event):
+    db.add_all([
+        schemas.CalendarEvent(id=id, schedule_event_id=1, status="scheduled",
+                              start_time=datetime.datetime(2024, 1, 1 + id % 2))
+        for id in (11, 12, 13, 14)
+    ])
+    db.add_all([
+        schemas.ParticipantActivityStatus(ppmi_id=7, calendar_event_id=11, activity_id=1, status="started"),
+        schemas.ParticipantActivityStatus(ppmi_id=7, calendar_event_id=12, activity_id=2, status="started"),
+        schemas.ParticipantActivityStatus(ppmi_id=7, calendar_event_id=13, activity_id=1, status="started"),
+        # another participant's event
+        schemas.ParticipantActivityStatus(ppmi_id=8, calendar_event_id=14, activity_id=1, status="started"),
+    ])
+    db.commit()
+    statements = count_queries(db)
+    start = datetime.datetime(2024, 1, 1)
+
+    first = activity_service.list_participant_activities(db, 7, start=start, limit=2)
+    after = activity_service.decode_events_cursor(first.next_cursor)
+    second = activity_service.list_participant_activities(db, 7, start=start, limit=2, after=after)
+
+    assert len(statements) == 4
+    # 10 has no start_time, 12 starts a day before 11 and 13, 14 belongs to participant 8
+    assert [event.event_id for event in first.events + second.events] == [12, 11, 13]
+    assert second.next_cursor is None
+    statuses = {activity.activity_id: activity.status for activity in first.events[0].activities}
+    assert statuses == {1: None, 2: "started", 3: None}
+    assert [event.event_id for event in activity_service.list_participant_activities(
+        db, 7, start=datetime.datetime(2024, 1, 2), event_ids=[11, 12, 14]).events] == [11]
+    with pytest.raises(ValueError):
+        activity_service.list_participant_activities(db, 7)
+    with pytest.raises(ValueError):
+        activity_service.decode_events_cursor("not a cursor")
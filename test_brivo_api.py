@@ -0,0 +1,95 @@
+import json
+import time
+import pytest
+from django.conf import settings
+from django.core.cache import cache
+
+if not settings.configured:
+    settings.configure(BRIVO_CLIENT_ID="client", BRIVO_CLIENT_SECRET="secret", BRIVO_API_KEY="key")
+
+from apies import brivo_api
+from apies.brivo_api import BrivoApi
+from apies.brivo_stub_server import BrivoStubServer
+
+
+@pytest.fixture
+def creds(tmp_path):
+    path = tmp_path / "brivo.json"
+    path.write_text(json.dumps({
+        "access_token": "token",
+        "refresh_token": "refresh",
+        "expires_in": time.time() + 3600,
+    }))
+    return str(path)
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    with BrivoStubServer(fail_every=3) as server:
+        monkeypatch.setattr(BrivoApi, "base_url", server.base_url)
+        monkeypatch.setattr(BrivoApi, "backoff_base", 0)
+        yield server
+
+
+# pylint: disable=redefined-outer-name
+def test_provision_tenants(creds, stub):
+    tenants = [
+        {
+            "firstName": f"first {i}",
+            "lastName": f"last {i}",
+            "emails": [{"address": f"tenant{i}@abc.com", "type": "home"}],
+        }
+        for i in range(20)
+    ]
+    tenants[5]["group_id"] = 7
+
+    report = BrivoApi(creds).provision_tenants(tenants, group_id=3, parallelism=4)
+
+    assert [item["index"] for item in report] == list(range(20))
+    assert all(item["error"] is None and item["assigned"] for item in report)
+    assert all(1000 <= item["pin"] <= 9999 for item in report)
+    assert len(stub.users) == 20
+    assert stub.groups[7] == {report[5]["user_id"]}
+    assert len(stub.groups[3]) == 19
+    assert brivo_api.connection_stats()["reused"] > 0
+
+
+def test_provision_tenants_reports_failures(creds, stub):
+    stub.fail_every = 1
+    stub.fail_status = 503
+
+    report = BrivoApi(creds).provision_tenants([{"firstName": "a", "lastName": "b"}], group_id=3)
+
+    assert report[0]["user_id"] is None
+    assert report[0]["error"]
+    assert not stub.users
+    # 503 on POST /users is not repeated, the user may exist already
+    assert len([call for call in stub.calls if call == ("POST", "/v1/api/users")]) == 1
+
+
+def test_membership_cache_invalidated_on_assign(creds, stub):
+    stub.fail_every = 0
+    brivo = BrivoApi(creds)
+    user = brivo.create_user({"firstName": "a", "lastName": "b"})
+    cache.clear()
+
+    assert brivo.retrieve_user_groups(user["id"])["data"] == []
+    assert brivo.retrieve_user_groups(user["id"])["data"] == []
+    assert brivo_api.cache_stats()["memberships"]["hits"] >= 1
+    brivo.assign_user_to_group(user["id"], 3)
+
+    assert brivo.retrieve_user_groups(user["id"])["data"] == [{"id": 3}]
+    assert len([call for call in stub.calls if call[1].endswith("/groups")]) == 2
+
+
+def test_group_lookup_cached(creds, stub):
+    stub.fail_every = 0
+    stub.groups.update({1: set(), 2: set()})
+    cache.clear()
+    brivo = BrivoApi(creds)
+
+    assert brivo.list_groups("first")["count"] == 2
+    brivo.assign_user_to_group(5, 1)
+
+    assert brivo.list_groups("first")["count"] == 2
+    assert len([call for call in stub.calls if call[0] == "GET" and call[1].startswith("/v1/api/groups?")]) == 1
@@ -10,10 +10,12 @@ from .serializers import LocationSerializer, TenantSerializer, OneLocationSerial
     ListPaymentsSerializer, CreatePaymentsSerializer, TenantSubscriptionSerializer, UnitCategoryPriceSerializer, \
     CheckPromoDodeSerializer
 from rest_framework.response import Response
-from .helper.destination_helper import get_distance_by_address
+from .helper.destination_helper import geocode_search
 from .helper.docusign_signing import embedded_signing, update_token
 from .helper.subscription_helper import make_subscription_charge, calculate_discount_sum
 from .helper.refund_helper import make_refund
+from .helper.payment_method_service import add_payment_method
+from .helper import calendly_jobs
 from django.conf import settings
 from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework import status
@@ -27,7 +29,6 @@ from django.views.decorators.csrf import csrf_exempt
 from django.template.response import TemplateResponse
 from django.views.decorators.clickjacking import xframe_options_exempt
 from apies.brivo_api import BrivoApi
-from dateutil.parser import parse
 from django.http import HttpResponseRedirect
 import requests
 import base64
@@ -37,6 +38,7 @@ import os
 import pickle
 import json
 import stripe
+import hashlib
 
 api_client = ApiClient(oauth_host_name=settings.DOCUSIGN_OAUTH_HOST_NAME)
 stripe.api_key = settings.STRIPE_SECRET_KEY
@@ -68,7 +70,14 @@ class LocationView(viewsets.GenericViewSet, mixins.ListModelMixin, mixins.Retrie
         if not search:
             serializer = self.get_serializer([], many=True)
             return Response(serializer.data)
-        queryset = get_distance_by_address(queryset, search, self.location_limit, self.threshold)
+        lat_long = geocode_search(search)
+        if not lat_long:
+            print(f'User address is not found . Address {search}')
+            serializer = self.get_serializer([], many=True)
+            return Response(serializer.data)
+        # prefetch of the queryset runs after the distance query, so only for the returned locations
+        queryset = queryset.filter(address__isnull=False)\
+            .nearby(lat_long[0], lat_long[1], self.threshold, self.location_limit)
         serializer = self.get_serializer(queryset, many=True)
         return Response(serializer.data)
 
@@ -104,67 +113,10 @@ class PaymentsViewSet(viewsets.ModelViewSet):
         if not token:
             raise ValidationError(detail={'detail': "Token is not provided"})
 
-        try:
-            customer = stripe.Customer.retrieve(user.stripe_id)
-        except Exception:
-            try:
-                customer = stripe.Customer.create(
-                    email=user.email
-                )
-            except stripe.error.StripeError as e:
-                raise ValidationError(detail={'detail': e.error.message})
-        user.stripe_id = customer.id
-        user.save()
-        try:
-            token = stripe.Token.retrieve(token)
-        except stripe.error.StripeError as e:
-            raise ValidationError(detail={'detail': e.error.message})
-        try:
-            card_print = token['card']['fingerprint']
-            p = Payments.objects.filter(fingerprint=card_print, tenant=user)
-        except Exception as e:
-            bank_print = token['bank_account']['fingerprint']
-            p = Payments.objects.filter(tenant=user, fingerprint=bank_print)
-
-        try:
-            source = stripe.Customer.create_source(
-                user.stripe_id,
-                source=token
-            )
-            source_id = source['id']
-            stripe.Customer.modify(
-                user.stripe_id,
-                default_source=source_id
-            )
-            bank_account = stripe.Customer.retrieve_source(
-                user.stripe_id,
-                source_id
-            )
-            try:
-                bank_account.verify(amounts=[32, 45])
-            except Exception as e:
-                print(e)
-        except stripe.error.StripeError as e:
-            if e.error.decline_code == 'do_not_honor':
-                raise ValidationError(detail={'detail': 'Card declined. '
-                                                        'Please contact your card issuer for more information.'})
-            raise ValidationError(detail={'detail': e.error.message})
-        fingerprint = source.get('fingerprint', None)
-        card_type = source.get('brand', None)
-        last_4 = source.get('last4', None)
-        card_id = source.get('id', None)
-        exp_month = source.get('exp_month', None)
-        exp_year = source.get('exp_year', None)
-        type = source.get('type', None)
-        try:
-            exp_date = date(year=exp_year, month=exp_month, day=1)
-        except Exception:
-            exp_date = None
-        p = Payments.objects.create(tenant=user, stripe_id=card_id, last_4=last_4, card_type=card_type,
-                                    expire_date=exp_date, fingerprint=fingerprint, type=type)
+        p, created = add_payment_method(user, token)
 
         serializer = ListPaymentsSerializer(p, many=False)
-        return Response(serializer.data, status=status.HTTP_201_CREATED)
+        return Response(serializer.data, status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
 
 
 class WaitListCreate(viewsets.GenericViewSet, mixins.CreateModelMixin):
@@ -471,52 +423,24 @@ def send_change_card_email_view(request):
 
 @csrf_exempt
 def calendly_hook(request):
-    brivo = BrivoApi(settings.BRIVO_API_CREDENTIAL)
-    phone_field_name = 'phone number'
-
-    response = json.loads(request.body)
+    """
+    Validate and store the delivery, Brivo provisioning and email are done by calendly_jobs workers.
+    Duplicate deliveries of the same invitee event answer with state of the stored job
+    """
+    try:
+        response = json.loads(request.body)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid JSON'}, status=400)
     payload = response.get('payload', {})
-    event = payload.get('event', {})
-    event_type = payload.get('event_type', {})
     invitee = payload.get('invitee', {})
-    questions = payload.get('questions_and_answers', {})
-    start_time = event.get('start_time')
-
-    event_name = event_type.get('name')
-    user_email = invitee.get('email')
-    user_name = invitee.get('name')
-    phone = [q['answer'] for q in questions if q['question'].lower() == phone_field_name][0]
-    first_name = invitee.get('first_name')
-    last_name = invitee.get('last_name')
-
-    location = Location.objects.filter(title__icontains=event_name.strip()).first()
-    if not location:
-        print(f'Location {event_name} not found')
-        return
-    end_time = parse(start_time) + timedelta(days=1)
-    end_time = end_time.strftime('%Y-%m-%dT%H:%M:%SZ')
-    data = {
-        'firstName': first_name if first_name else user_name,
-        'lastName': last_name if last_name else user_name,
-        'emails': [{"address": user_email, "type": 'home'}],
-        'phoneNumbers': [{"number": phone, "type": 'home'}],
-        'effectiveFrom': start_time,
-        'effectiveTo': end_time
-    }
-    tenant = brivo.create_user(data)
-    print(tenant)
-    if not tenant.get('id'):
-        return
-
-    print('Tenant Created')
-    if location.brivo_group and location.brivo_group.brivo_id:
-        brivo.assign_user_to_group(tenant['id'], location.brivo_group.brivo_id)
-    start_time = parse(start_time)
-    send_mail(
-        context={'location': location, 'tour_date': start_time.strftime("%B %d, %Y at %I:%M %p"), 'pin': tenant['pin'],
-                 'pin_effective_date': start_time.strftime("%B %d, %Y"), 'name': first_name if first_name else user_name},
-        template='email/calendly_welcome.html', title='Local Locker Tour Confirmation',
-        to=[user_email]
-    )
-
-    return JsonResponse({'status': 'ok'})
+    if not all([payload.get('event', {}).get('start_time'), payload.get('event_type', {}).get('name'),
+                invitee.get('email')]):
+        return JsonResponse({'error': 'event/event_type/invitee not specified.'}, status=400)
+    if not calendly_jobs.phone_answer(payload.get('questions_and_answers', {})):
+        return JsonResponse({'error': f'"{calendly_jobs.phone_field_name}" answer not specified.'}, status=400)
+
+    delivery_id = invitee.get('uuid') or hashlib.sha1(request.body).hexdigest()
+    state, created = calendly_jobs.enqueue(f"calendly_hook:{response.get('event')}:{delivery_id}", payload)
+    if not created:
+        return JsonResponse({'status': 'duplicate', 'state': state}, status=200)
+    return JsonResponse({'status': 'accepted'}, status=202)